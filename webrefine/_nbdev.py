@@ -9,45 +9,142 @@ index = {"WarcFileRecord": "01_query.ipynb",
          "get_warc_status": "01_query.ipynb",
          "get_warc_digest": "01_query.ipynb",
          "WarcFileQuery": "01_query.ipynb",
+         "warc_index_path": "01_query.ipynb",
+         "write_warc_index": "01_query.ipynb",
+         "read_warc_index": "01_query.ipynb",
+         "CDXJ_SUFFIX": "01_query.ipynb",
+         "read_warc_contents": "01_query.ipynb",
+         "warc_fetch_parallel": "01_query.ipynb",
+         "WARC_SKIP_GAP": "01_query.ipynb",
+         "WarcFileRecord.fetch_parallel": "01_query.ipynb",
+         "WarcDirectoryQuery": "01_query.ipynb",
          "header_and_rows_to_dict": "01_query.ipynb",
          "mimetypes_to_regex": "01_query.ipynb",
          "query_wayback_cdx": "01_query.ipynb",
          "IA_CDX_URL": "01_query.ipynb",
          "CaptureIndexRecord": "01_query.ipynb",
+         "PayloadTooLarge": "01_query.ipynb",
+         "copy_limited": "01_query.ipynb",
+         "STREAM_CHUNK_SIZE": "01_query.ipynb",
+         "MAX_PAYLOAD_SIZE": "01_query.ipynb",
          "wayback_url": "01_query.ipynb",
+         "fetch_wayback_content_stream": "01_query.ipynb",
          "fetch_wayback_content": "01_query.ipynb",
+         "IA_WAYBACK_URL": "01_query.ipynb",
          "WaybackRecord": "01_query.ipynb",
          "WaybackQuery": "01_query.ipynb",
          "wayback_fetch_parallel": "01_query.ipynb",
          "WaybackRecord.fetch_parallel": "01_query.ipynb",
+         "cc_cache": "01_query.ipynb",
          "get_cc_indexes": "01_query.ipynb",
+         "CC_INDEX_URL": "01_query.ipynb",
+         "CC_CACHE_PATH": "01_query.ipynb",
+         "CC_CACHE_TTL": "01_query.ipynb",
          "parse_cc_crawl_date": "01_query.ipynb",
+         "CrawlDateIndex": "01_query.ipynb",
+         "cc_crawl_index": "01_query.ipynb",
          "cc_index_by_time": "01_query.ipynb",
          "jsonl_loads": "01_query.ipynb",
+         "jsonl_columns": "01_query.ipynb",
          "CC_PAGE_SIZE": "01_query.ipynb",
          "query_cc_cdx_num_pages": "01_query.ipynb",
          "query_cc_cdx_page": "01_query.ipynb",
          "CC_API_FILTER_BLACKLIST": "01_query.ipynb",
+         "fetch_cc_stream": "01_query.ipynb",
          "fetch_cc": "01_query.ipynb",
          "CC_DATA_URL": "01_query.ipynb",
          "CommonCrawlRecord": "01_query.ipynb",
+         "query_cc_cdx_serial": "01_query.ipynb",
+         "query_cc_cdx_concurrent": "01_query.ipynb",
+         "CC_QUERY_THREADS": "01_query.ipynb",
          "CommonCrawlQuery": "01_query.ipynb",
+         "CCRange": "01_query.ipynb",
+         "plan_cc_ranges": "01_query.ipynb",
+         "fetch_cc_range": "01_query.ipynb",
+         "CC_COALESCE_GAP": "01_query.ipynb",
+         "CC_COALESCE_SIZE": "01_query.ipynb",
          "cc_fetch_parallel": "01_query.ipynb",
          "CommonCrawlRecord.fetch_parallel": "01_query.ipynb",
+         "CDXBatch": "01_query.ipynb",
          "Process": "02_runners.ipynb",
+         "transform_parallel": "02_runners.ipynb",
          "RunnerMemory": "02_runners.ipynb",
+         "IdentityCodec": "02_runners.ipynb",
+         "ZlibCodec": "02_runners.ipynb",
+         "ZstdCodec": "02_runners.ipynb",
+         "make_codec": "02_runners.ipynb",
+         "encode_payload": "02_runners.ipynb",
+         "decode_payload": "02_runners.ipynb",
+         "ZSTD_DICT_SIZE": "02_runners.ipynb",
+         "CODECS": "02_runners.ipynb",
+         "ShardedSqliteDict": "02_runners.ipynb",
+         "BlobStore": "02_runners.ipynb",
          "minibatch": "02_runners.ipynb",
          "compress_encode": "02_runners.ipynb",
          "compress_decode": "02_runners.ipynb",
+         "dedup_by_digest": "02_runners.ipynb",
          "RunnerCached": "02_runners.ipynb",
+         "records_to_table": "02_runners.ipynb",
+         "table_to_records": "02_runners.ipynb",
+         "step_version": "02_runners.ipynb",
+         "step_keys": "02_runners.ipynb",
+         "LeaseQueue": "02_runners.ipynb",
+         "run_fetch_workers": "02_runners.ipynb",
          "sha1_digest": "03_util.ipynb",
          "URL": "03_util.ipynb",
-         "make_session": "03_util.ipynb"}
+         "make_session": "03_util.ipynb",
+         "parse_retry_after": "03_util.ipynb",
+         "AdaptiveController": "03_util.ipynb",
+         "default_controller": "03_util.ipynb",
+         "THROTTLE_STATUS": "03_util.ipynb",
+         "__getattr__": "03_util.ipynb",
+         "TTLCache": "03_util.ipynb",
+         "WarcRangeServer": "04_testserver.ipynb",
+         "warc_to_cc_records": "04_testserver.ipynb",
+         "cc_data_url": "04_testserver.ipynb",
+         "ArchiveServer": "04_testserver.ipynb",
+         "standin_urls": "04_testserver.ipynb",
+         "RETRY_STATUS": "05_aio.ipynb",
+         "fetch_wayback_content_async": "05_aio.ipynb",
+         "fetch_cc_async": "05_aio.ipynb",
+         "WaybackRecord.get_content_async": "05_aio.ipynb",
+         "CommonCrawlRecord.get_content_async": "05_aio.ipynb",
+         "WarcFileRecord.get_content_async": "05_aio.ipynb",
+         "aio_fetch_parallel": "05_aio.ipynb",
+         "BenchmarkResult": "06_benchmark.ipynb",
+         "measure": "06_benchmark.ipynb",
+         "bench_warc_query": "06_benchmark.ipynb",
+         "bench_wayback_query": "06_benchmark.ipynb",
+         "bench_cc_query": "06_benchmark.ipynb",
+         "query_benchmarks": "06_benchmark.ipynb",
+         "bench_fetch": "06_benchmark.ipynb",
+         "bench_aio_fetch": "06_benchmark.ipynb",
+         "fetch_benchmarks": "06_benchmark.ipynb",
+         "bench_cache": "06_benchmark.ipynb",
+         "cache_benchmarks": "06_benchmark.ipynb",
+         "extract_title": "06_benchmark.ipynb",
+         "bench_transform": "06_benchmark.ipynb",
+         "transform_benchmarks": "06_benchmark.ipynb",
+         "bench_record_memory": "06_benchmark.ipynb",
+         "memory_benchmarks": "06_benchmark.ipynb",
+         "run_benchmarks": "06_benchmark.ipynb",
+         "main": "06_benchmark.ipynb",
+         "Metrics": "07_metrics.ipynb",
+         "MetricsRecorder": "07_metrics.ipynb",
+         "DEFAULT_BUCKETS": "07_metrics.ipynb",
+         "prometheus_text": "07_metrics.ipynb",
+         "PrometheusTextFile": "07_metrics.ipynb",
+         "JsonLinesFile": "07_metrics.ipynb",
+         "StepProfiler": "07_metrics.ipynb"}
 
 modules = ["core.py",
            "query.py",
            "runners.py",
-           "util.py"]
+           "util.py",
+           "testserver.py",
+           "aio.py",
+           "benchmark.py",
+           "metrics.py"]
 
 doc_url = "https://EdwardJRoss.github.io/webrefine/"
 
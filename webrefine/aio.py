@@ -0,0 +1,164 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/05_aio.ipynb (unless otherwise specified).
+
+
+from __future__ import annotations
+
+
+__all__ = ['RETRY_STATUS', 'fetch_wayback_content_async', 'fetch_cc_async', 'aio_fetch_parallel']
+
+# Cell
+#nbdev_comment from __future__ import annotations
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+from collections.abc import Iterable
+from typing import Any, Callable, Generator, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .query import (WarcFileRecord, WaybackRecord, CommonCrawlRecord, PayloadTooLarge, STREAM_CHUNK_SIZE,
+                             wayback_url, _cc_range_request, _decode_cc_warc, _max_payload_size)
+from .util import AdaptiveController, THROTTLE_STATUS, default_controller
+
+# Cell
+RETRY_STATUS = {500, 504}
+
+async def _read_limited(response: aiohttp.ClientResponse, max_size: Optional[int] = None) -> bytes:
+    if max_size is None:
+        return await response.read()
+    chunks = []
+    size = 0
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_size:
+            raise PayloadTooLarge(f'Content is over {max_size} bytes')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+async def _get(session: aiohttp.ClientSession, url: str, headers: Optional[dict[str, str]] = None,
+               missing_ok: bool = False, retries: int = 5, backoff_factor: float = 1,
+               controller: Optional[AdaptiveController] = None, max_size: Optional[int] = None) -> Optional[bytes]:
+    host = urlsplit(url).netloc
+    for attempt in range(retries + 1):
+        if controller is not None:
+            await controller.acquire_async(host)
+        start = time.monotonic()
+        status, retry_after, error = None, None, False
+        try:
+            async with session.get(url, headers=headers) as response:
+                status, retry_after = response.status, response.headers.get('Retry-After')
+                if response.status not in RETRY_STATUS | THROTTLE_STATUS or attempt == retries:
+                    if missing_ok and response.status == 404:
+                        return None
+                    response.raise_for_status()
+                    return await _read_limited(response, max_size)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            error = True
+            if attempt == retries:
+                raise
+        finally:
+            if controller is not None:
+                controller.release(host, time.monotonic() - start, status=status, retry_after=retry_after, error=error)
+        if controller is None or status not in THROTTLE_STATUS:
+            await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+# Cell
+async def fetch_wayback_content_async(timestamp: str, url: str, session: aiohttp.ClientSession,
+                                      controller: Optional[AdaptiveController] = None,
+                                      max_payload_size: Optional[int] = None) -> Optional[bytes]:
+    url = wayback_url(timestamp, url)
+    content = await _get(session, url, missing_ok=True, controller=controller, max_size=max_payload_size)
+    # Sometimes Internet Archive deletes records
+    if content is None:
+        logging.warning(f'Missing {url}')
+    return content
+
+async def fetch_cc_async(filename: str, offset: int, length: int, session: aiohttp.ClientSession,
+                         controller: Optional[AdaptiveController] = None,
+                         max_payload_size: Optional[int] = None) -> bytes:
+    data_url, headers = _cc_range_request(filename, offset, length)
+    content = await _get(session, data_url, headers=headers, controller=controller, max_size=max_payload_size)
+    return _decode_cc_warc(content, max_payload_size)
+
+# Cell
+async def _skip_too_large(record, content):
+    try:
+        return await content
+    except PayloadTooLarge as e:
+        logging.warning(f'Skipping {record.url}: {e}')
+        return None
+
+async def _wayback_get_content_async(self, session: aiohttp.ClientSession,
+                                     controller: Optional[AdaptiveController] = None,
+                                     max_payload_size: Optional[int] = None) -> Optional[bytes]:
+    return await _skip_too_large(self, fetch_wayback_content_async(self.timestamp_str, self.url, session, controller=controller,
+                                                                   max_payload_size=_max_payload_size(max_payload_size)))
+
+async def _cc_get_content_async(self, session: aiohttp.ClientSession,
+                                controller: Optional[AdaptiveController] = None,
+                                max_payload_size: Optional[int] = None) -> Optional[bytes]:
+    return await _skip_too_large(self, fetch_cc_async(self.filename, self.offset, self.length, session, controller=controller,
+                                                      max_payload_size=_max_payload_size(max_payload_size)))
+
+async def _warc_get_content_async(self, session: aiohttp.ClientSession,
+                                  controller: Optional[AdaptiveController] = None,
+                                  max_payload_size: Optional[int] = None) -> bytes:
+    return await asyncio.get_event_loop().run_in_executor(None, self.get_content)
+
+WaybackRecord.get_content_async = _wayback_get_content_async
+CommonCrawlRecord.get_content_async = _cc_get_content_async
+WarcFileRecord.get_content_async = _warc_get_content_async
+
+# Cell
+async def _make_session(concurrency: int) -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+
+async def _cancel_and_close(session: aiohttp.ClientSession) -> None:
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await session.close()
+
+
+def aio_fetch_parallel(records: Iterable[Any], concurrency: int = 128, callback: Optional[Callable] = None,
+                       controller: Optional[AdaptiveController] = None,
+                       max_payload_size: Optional[int] = None) -> Generator[tuple[Optional[bytes], Any], None, None]:
+    """Fetch the content of records with asyncio, yielding (content, record) as each request finishes.
+
+    Keeps up to concurrency requests in flight, fewer while controller (by default the shared one) is backing off;
+    callback(record, content) is called for each result."""
+    controller = controller or default_controller()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    session = asyncio.run_coroutine_threadsafe(_make_session(concurrency), loop).result()
+
+    pending = {}
+    def submit(records):
+        # Called from this thread, so records is only ever iterated here
+        for record in records:
+            content = record.get_content_async(session, controller=controller, max_payload_size=max_payload_size)
+            pending[asyncio.run_coroutine_threadsafe(content, loop)] = record
+
+    records = iter(records)
+    try:
+        submit(itertools.islice(records, concurrency))
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                record = pending.pop(future)
+                content = future.result()
+                submit(itertools.islice(records, 1))
+                if callback is not None:
+                    callback(record, content)
+                yield content, record
+    finally:
+        asyncio.run_coroutine_threadsafe(_cancel_and_close(session), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
\ No newline at end of file
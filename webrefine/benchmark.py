@@ -0,0 +1,266 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/06_benchmark.ipynb (unless otherwise specified).
+
+
+from __future__ import annotations
+
+
+__all__ = ['BenchmarkResult', 'measure', 'bench_warc_query', 'bench_wayback_query', 'bench_cc_query',
+           'query_benchmarks', 'bench_fetch', 'bench_aio_fetch', 'fetch_benchmarks', 'bench_cache', 'cache_benchmarks',
+           'extract_title', 'bench_transform', 'transform_benchmarks', 'bench_record_memory', 'memory_benchmarks',
+           'run_benchmarks', 'main']
+
+# Cell
+#nbdev_comment from __future__ import annotations
+import argparse
+import json
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+import webrefine
+from .query import (WarcFileQuery, WaybackQuery, CommonCrawlQuery, WaybackRecord, CommonCrawlRecord,
+                             warc_fetch_parallel, wayback_fetch_parallel, cc_fetch_parallel)
+from .runners import Process, RunnerCached, transform_parallel
+from .testserver import ArchiveServer, standin_urls
+
+# Cell
+def _jsonable(value):
+    """Describe a parameter, like a server or a list of records, that isn't JSON"""
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return f'<{len(value)} items>'
+    return getattr(value, '__name__', type(value).__name__)
+
+@dataclass
+class BenchmarkResult:
+    stage: str
+    name: str
+    records: int
+    bytes: int
+    seconds: float
+    params: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def records_per_second(self) -> float:
+        return self.records / self.seconds if self.seconds else float('inf')
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds else float('inf')
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(stage=self.stage, name=self.name, records=self.records, bytes=self.bytes, seconds=self.seconds,
+                    records_per_second=self.records_per_second, bytes_per_second=self.bytes_per_second,
+                    params={k: _jsonable(v) for k, v in self.params.items()})
+
+
+def measure(stage: str, name: str, func: Callable, repeat: int = 3, setup: Optional[Callable] = None, **params) -> BenchmarkResult:
+    """Time func(**params), or func(setup(), **params), returning the fastest of repeat runs"""
+    best = None
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        records, size = func(*args, **params)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best.seconds:
+            best = BenchmarkResult(stage, name, records, size, seconds, params)
+    return best
+
+# Cell
+def _sent(server: ArchiveServer, func: Callable) -> tuple[int, int]:
+    """Run func, returning the number of records it returns and the bytes server sent meanwhile"""
+    start = server.bytes_sent
+    records = func()
+    return len(records), server.bytes_sent - start
+
+def bench_warc_query(paths: list[Path], index: bool = False) -> tuple[int, int]:
+    records = [r for path in paths for r in WarcFileQuery(path, index=index).query()]
+    return len(records), sum(path.stat().st_size for path in paths)
+
+def bench_wayback_query(server: ArchiveServer, url: str) -> tuple[int, int]:
+    return _sent(server, lambda: list(WaybackQuery(url, start=None, end=None).query()))
+
+def bench_cc_query(server: ArchiveServer, url: str, page_size: int = 5, threads: Optional[int] = None) -> tuple[int, int]:
+    query = CommonCrawlQuery(url, apis=[server.archive.crawl])
+    return _sent(server, lambda: list(query.query(page_size=page_size, threads=threads)))
+
+def query_benchmarks(server: ArchiveServer, paths: list[Path], url: str, repeat: int = 3) -> list[BenchmarkResult]:
+    results = [measure('query', 'warc', bench_warc_query, repeat, paths=paths)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        copied_paths = [Path(shutil.copy(path, Path(tmpdir) / f'{n}-{path.name}')) for n, path in enumerate(paths)]
+        results.append(measure('query', 'warc_index', bench_warc_query, repeat, paths=copied_paths, index=True))
+    results.append(measure('query', 'wayback', bench_wayback_query, repeat, server=server, url=url))
+    for page_size in [1, 5]:
+        for threads in [None, 8]:
+            results.append(measure('query', 'common_crawl', bench_cc_query, repeat,
+                                   server=server, url=url, page_size=page_size, threads=threads))
+    return results
+
+# Cell
+def _content_size(contents) -> tuple[int, int]:
+    contents = list(contents)
+    return len(contents), sum(len(c) for c in contents if c is not None)
+
+def bench_fetch(fetch_parallel: Callable, records: list, **kwargs) -> tuple[int, int]:
+    return _content_size(fetch_parallel(records, **kwargs))
+
+def bench_aio_fetch(records: list, concurrency: int = 128) -> tuple[int, int]:
+    from .aio import aio_fetch_parallel
+    return _content_size(content for content, _ in aio_fetch_parallel(records, concurrency=concurrency))
+
+def fetch_benchmarks(warc_records: list, wayback_records: list, cc_records: list, repeat: int = 3) -> list[BenchmarkResult]:
+    results = []
+    for threads in [1, 4]:
+        results.append(measure('fetch', 'warc', bench_fetch, repeat, fetch_parallel=warc_fetch_parallel,
+                               records=warc_records, threads=threads))
+    for threads in [8, 32]:
+        results.append(measure('fetch', 'wayback', bench_fetch, repeat, fetch_parallel=wayback_fetch_parallel,
+                               records=wayback_records, threads=threads))
+        for max_gap in [None, 64 * 1024]:
+            results.append(measure('fetch', 'common_crawl', bench_fetch, repeat, fetch_parallel=cc_fetch_parallel,
+                                   records=cc_records, threads=threads, max_gap=max_gap))
+    try:
+        import aiohttp
+    except ImportError:
+        return results
+    for concurrency in [32, 128]:
+        results.append(measure('fetch', 'aio_common_crawl', bench_aio_fetch, repeat, records=cc_records, concurrency=concurrency))
+    return results
+
+# Cell
+def _cache_process() -> Process:
+    return Process(queries=[], steps=[], filter=lambda records: records)
+
+def bench_cache(runner: RunnerCached, records: list, **config) -> tuple[int, int]:
+    # config is how runner was made, so it's reported with the result
+    return _content_size(content for content, _ in runner.fetch(records))
+
+def cache_benchmarks(records: list, repeat: int = 3, **kwargs) -> list[BenchmarkResult]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        runs = iter(range(sys.maxsize))
+        def make_runner(**runner_kwargs):
+            return RunnerCached(_cache_process(), Path(tmpdir) / f'cache{next(runs)}.sqlite', progress_bar=False, **runner_kwargs)
+
+        configs = [dict(codec=codec, batch_size=batch_size) for codec in ['none', 'zlib'] for batch_size in [16, 1024]]
+        configs.append(dict(blob_store=True, batch_size=1024))
+        for config in configs:
+            params = dict(config, **kwargs)
+            results.append(measure('cache', 'miss', bench_cache, repeat, setup=lambda: make_runner(**params),
+                                   records=records, **params))
+            runner = make_runner(**params)
+            bench_cache(runner, records, **params)
+            results.append(measure('cache', 'hit', bench_cache, repeat, setup=lambda: runner, records=records, **params))
+    return results
+
+# Cell
+_TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+def extract_title(content, record) -> Optional[str]:
+    match = _TITLE_RE.search(bytes(content))
+    return match and match.group(1).decode('utf-8', errors='replace').strip()
+
+def bench_transform(content_records: list, workers: Optional[int] = None) -> tuple[int, int]:
+    outputs = list(transform_parallel(content_records, [extract_title], workers))
+    return len(outputs), sum(len(content) for content, _ in content_records)
+
+def transform_benchmarks(content_records: list, repeat: int = 3) -> list[BenchmarkResult]:
+    return [measure('transform', 'extract_title', bench_transform, repeat, content_records=content_records, workers=workers)
+            for workers in [None, 2]]
+
+# Cell
+import tracemalloc
+
+_MIMES = ['text/html', 'text/css', 'application/javascript', 'image/png']
+
+def _synthetic_cdx(record_type: type, count: int, start: int = 0):
+    """Yield count CDX results for record_type, with distinct URLs and digests, and a few hundred WARC files"""
+    for i in range(start, start + count):
+        url = f'https://example.com/{i % 1000}/page-{i}'
+        timestamp = f'202110{1 + i % 28:02}{i % 24:02}{i % 60:02}{i // 60 % 60:02}'
+        mime = _MIMES[i % len(_MIMES)]
+        digest = f'{i:032X}'
+        if record_type is WaybackRecord:
+            yield dict(original=url, timestamp=timestamp, mimetype=mime, statuscode='200', digest=digest)
+        else:
+            filename = (f'crawl-data/CC-MAIN-2021-43/segments/1634323585{i % 100:03}.17/warc/'
+                        f'CC-MAIN-20211024050128-20211024080128-{i % 640:05}.warc.gz')
+            yield dict(url=url, timestamp=timestamp, filename=filename, offset=str(i * 5_000), length=str(2_000 + i % 3_000),
+                       mime=mime, status='200', digest=digest)
+
+def bench_record_memory(record_type: type, count: int = 100_000) -> tuple[int, int]:
+    """Hold count records of record_type, returning count and the bytes of memory they take"""
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        records = [record_type.from_dict(r) for r in _synthetic_cdx(record_type, count)]
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return len(records), size
+
+def memory_benchmarks(count: int = 100_000) -> list[BenchmarkResult]:
+    # The memory doesn't change between runs, and tracing is slow, so only run once
+    return [measure('memory', record_type.__name__, bench_record_memory, 1, record_type=record_type, count=count)
+            for record_type in [WaybackRecord, CommonCrawlRecord]]
+
+# Cell
+def run_benchmarks(data_dir: Union[str, Path] = 'resources/test', copies: int = 10, repeat: int = 3,
+                   latency: float = 0.0, url: str = '*', memory_records: int = 100_000,
+                   output: Optional[Union[str, Path]] = None) -> dict[str, Any]:
+    """Run all the benchmarks on the WARC files in data_dir, returning the report and writing it as JSON to output"""
+    data_dir = Path(data_dir)
+    paths = sorted(data_dir.glob('**/*.warc.gz'))
+    if not paths:
+        raise ValueError(f'No WARC files in {data_dir}')
+    started = datetime.now(timezone.utc)
+
+    warc_records = [r for path in paths for r in WarcFileQuery(path).query()]
+    with ArchiveServer(data_dir, copies=copies, latency=latency) as server, standin_urls(server.url):
+        results = query_benchmarks(server, paths, url, repeat)
+        wayback_records = list(WaybackQuery(url, start=None, end=None).query())
+        cc_records = list(CommonCrawlQuery(url, apis=[server.archive.crawl]).query())
+        results += fetch_benchmarks(warc_records * copies, wayback_records, cc_records, repeat)
+        results += cache_benchmarks(cc_records, repeat)
+    content_records = list(zip(warc_fetch_parallel(warc_records), warc_records)) * copies
+    results += transform_benchmarks(content_records, repeat)
+    results += memory_benchmarks(memory_records)
+
+    report = dict(version=webrefine.__version__, python=platform.python_version(), platform=platform.platform(),
+                  started=started.isoformat(), config=dict(data_dir=str(data_dir), copies=copies, repeat=repeat,
+                                                           latency=latency, url=url, memory_records=memory_records),
+                  results=[result.to_dict() for result in results])
+    if output is not None:
+        Path(output).write_text(json.dumps(report, indent=2))
+    return report
+
+# Cell
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmark webrefine against local stand-in archives')
+    parser.add_argument('--data-dir', default='resources/test', help='Directory containing the WARC files to serve')
+    parser.add_argument('--copies', type=int, default=10, help='Number of times to repeat each capture')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each benchmark to take the fastest of')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the server waits before each response')
+    parser.add_argument('--memory-records', type=int, default=100_000, help='Number of records to hold in memory')
+    parser.add_argument('--output', default='benchmark.json', help='File to write the JSON results to')
+    args = parser.parse_args(argv)
+    report = run_benchmarks(args.data_dir, copies=args.copies, repeat=args.repeat, latency=args.latency,
+                            memory_records=args.memory_records, output=args.output)
+    for result in report['results']:
+        if result['stage'] == 'memory':
+            size = f"{result['bytes'] / result['records']:10,.1f} B/rec"
+        else:
+            size = f"{result['bytes_per_second'] / 1e6:10,.1f} MB/s"
+        print(f"{result['stage']:10} {result['name']:17} {result['records_per_second']:12,.0f} records/s "
+              f"{size}  {result['params']}")
\ No newline at end of file
@@ -3,4 +3,4 @@
 __all__ = []
 
 # Cell
-from .query import WarcFileQuery, WaybackQuery, CommonCrawlQuery
\ No newline at end of file
+from .query import WarcFileQuery, WarcDirectoryQuery, WaybackQuery, CommonCrawlQuery
\ No newline at end of file
@@ -0,0 +1,257 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/07_metrics.ipynb (unless otherwise specified).
+
+
+from __future__ import annotations
+
+
+__all__ = ['Metrics', 'MetricsRecorder', 'DEFAULT_BUCKETS', 'prometheus_text', 'PrometheusTextFile', 'JsonLinesFile',
+           'StepProfiler']
+
+# Cell
+#nbdev_comment from __future__ import annotations
+import bisect
+import cProfile
+import heapq
+import itertools
+import json
+import os
+import pstats
+import random
+import tracemalloc
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Union
+
+from .util import AdaptiveController
+
+# Cell
+class Metrics:
+    """Hook the runners report to, which ignores everything; MetricsRecorder records it"""
+    def count(self, name: str, value: float = 1, **labels):
+        pass
+
+    def gauge(self, name: str, value: float, **labels):
+        pass
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+    def flush(self):
+        pass
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        yield
+
+    def timed(self, iterable: Iterable, stage: str) -> Iterable:
+        return iterable
+
+# Cell
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+class MetricsRecorder(Metrics):
+    def __init__(self, exporters: Sequence = (), interval: float = 10., buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 controller: Optional[AdaptiveController] = None, clock: Callable[[], float] = time.time):
+        self.exporters = list(exporters)
+        self.interval = interval
+        self.buckets = tuple(sorted(buckets))
+        self.controller = controller
+        self.clock = clock
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._stages = threading.local()
+        self._last_flush = clock()
+
+    def _update(self, kind: dict, name: str, labels: dict, update: Callable):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            kind[key] = update(kind.get(key))
+            due = self.exporters and self.clock() - self._last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def count(self, name: str, value: float = 1, **labels):
+        self._update(self.counters, name, labels, lambda total: (total or 0) + value)
+
+    def gauge(self, name: str, value: float, **labels):
+        self._update(self.gauges, name, labels, lambda _: value)
+
+    def observe(self, name: str, value: float, **labels):
+        def update(histogram):
+            histogram = histogram or [[0] * len(self.buckets), 0., 0]
+            for i in range(bisect.bisect_left(self.buckets, value), len(self.buckets)):
+                histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+            return histogram
+        self._update(self.histograms, name, labels, update)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, iterable: Iterable, stage: str) -> Iterator:
+        # Time spent in the stages this one is pulling from, for each stage being timed in this thread
+        inner = self._stages.__dict__.setdefault('inner', [])
+        iterator = iter(iterable)
+        try:
+            while True:
+                inner.append(0.)
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - start
+                    own = elapsed - inner.pop()
+                    if inner:
+                        inner[-1] += elapsed
+                    self.count('stage_seconds', own, stage=stage)
+                self.count('stage_records', stage=stage)
+                yield item
+        finally:
+            self.flush()
+
+    def snapshot(self) -> dict[str, Any]:
+        """The current value of every metric"""
+        metrics = []
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                metrics.append(dict(name=name, type='counter', labels=dict(labels), value=value))
+            for (name, labels), value in self.gauges.items():
+                metrics.append(dict(name=name, type='gauge', labels=dict(labels), value=value))
+            for (name, labels), (counts, total, count) in self.histograms.items():
+                metrics.append(dict(name=name, type='histogram', labels=dict(labels), buckets=dict(zip(self.buckets, counts)),
+                                    sum=total, count=count))
+        if self.controller is not None:
+            for host, host_metrics in self.controller.metrics().items():
+                for name in ['requests', 'throttled', 'errors']:
+                    metrics.append(dict(name=f'http_{name}', type='counter', labels=dict(host=host), value=host_metrics[name]))
+                for name in ['concurrency', 'in_flight']:
+                    metrics.append(dict(name=f'http_{name}', type='gauge', labels=dict(host=host), value=host_metrics[name]))
+        return dict(time=self.clock(), metrics=metrics)
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = self.clock()
+        if self.exporters:
+            snapshot = self.snapshot()
+            for exporter in self.exporters:
+                exporter.export(snapshot)
+
+# Cell
+def _prometheus_labels(labels: dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def prometheus_text(snapshot: dict[str, Any], prefix: str = 'webrefine_') -> str:
+    """Format a MetricsRecorder snapshot in the Prometheus text exposition format"""
+    lines = []
+    typed = set()
+    for metric in sorted(snapshot['metrics'], key=lambda m: (m['name'], sorted(m['labels'].items()))):
+        name = prefix + metric['name'] + ('_total' if metric['type'] == 'counter' else '')
+        if name not in typed:
+            lines.append(f"# TYPE {name} {metric['type']}")
+            typed.add(name)
+        labels = metric['labels']
+        if metric['type'] != 'histogram':
+            lines.append(f"{name}{_prometheus_labels(labels)} {metric['value']}")
+            continue
+        for le, count in metric['buckets'].items():
+            lines.append(f"{name}_bucket{_prometheus_labels(dict(labels, le=le))} {count}")
+        lines.append(f"{name}_bucket{_prometheus_labels(dict(labels, le='+Inf'))} {metric['count']}")
+        lines.append(f"{name}_sum{_prometheus_labels(labels)} {metric['sum']}")
+        lines.append(f"{name}_count{_prometheus_labels(labels)} {metric['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusTextFile:
+    def __init__(self, path: Union[str, Path], prefix: str = 'webrefine_'):
+        self.path = Path(path)
+        self.prefix = prefix
+
+    def export(self, snapshot: dict[str, Any]):
+        tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(prometheus_text(snapshot, self.prefix))
+        os.replace(tmp_path, self.path)
+
+
+class JsonLinesFile:
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def export(self, snapshot: dict[str, Any]):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(snapshot) + '\n')
+
+# Cell
+class _ProfileStats:
+    """Stats from cProfile.Profile.create_stats, in the form pstats.Stats can load"""
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class StepProfiler:
+    def __init__(self, top_n: int = 10, memory: bool = True, sample_rate: float = 0., seed: Optional[int] = None):
+        self.top_n = top_n
+        self.memory = memory
+        self.sample_rate = sample_rate
+        self.totals = {}
+        # Step name -> heap of the (seconds, n, record description) of the slowest records
+        self.slowest = {}
+        self.stats = None
+        self._random = random.Random(seed)
+        self._counter = itertools.count()
+
+    def sample(self) -> bool:
+        """Whether to profile the next record"""
+        return self.sample_rate > 0 and self._random.random() < self.sample_rate
+
+    def record(self, step: str, seconds: float, memory: Optional[int], record: Any):
+        total = self.totals.setdefault(step, dict(records=0, seconds=0., max_seconds=0., max_memory=None))
+        total['records'] += 1
+        total['seconds'] += seconds
+        total['max_seconds'] = max(total['max_seconds'], seconds)
+        if memory is not None:
+            total['max_memory'] = max(total['max_memory'] or 0, memory)
+
+        entry = (seconds, next(self._counter), dict(url=getattr(record, 'url', None), digest=getattr(record, 'digest', None),
+                                                    seconds=seconds, memory=memory))
+        slowest = self.slowest.setdefault(step, [])
+        if len(slowest) < self.top_n:
+            heapq.heappush(slowest, entry)
+        elif seconds > slowest[0][0]:
+            heapq.heapreplace(slowest, entry)
+
+    def add_stats(self, stats: dict):
+        """Add the stats of a cProfile.Profile, after create_stats"""
+        if self.stats is None:
+            self.stats = pstats.Stats(_ProfileStats(stats))
+        else:
+            self.stats.add(_ProfileStats(stats))
+
+    def report(self) -> dict[str, dict[str, Any]]:
+        """Totals for each step, with the slowest records first"""
+        return {step: dict(total, mean_seconds=total['seconds'] / total['records'],
+                           slowest=[entry for _, _, entry in sorted(self.slowest[step], reverse=True)])
+                for step, total in self.totals.items()}
+
+    def dump_stats(self, path: Union[str, Path]):
+        if self.stats is None:
+            raise ValueError('No records were profiled; set sample_rate')
+        self.stats.dump_stats(path)
\ No newline at end of file
@@ -5,50 +5,181 @@ from __future__ import annotations # For Python <3.9
 
 
 __all__ = ['WarcFileRecord', 'get_warc_url', 'get_warc_timestamp', 'get_warc_mime', 'get_warc_status',
-           'get_warc_digest', 'WarcFileQuery', 'header_and_rows_to_dict', 'mimetypes_to_regex', 'query_wayback_cdx',
-           'IA_CDX_URL', 'CaptureIndexRecord', 'wayback_url', 'fetch_wayback_content', 'WaybackRecord', 'WaybackQuery',
-           'wayback_fetch_parallel', 'get_cc_indexes', 'parse_cc_crawl_date', 'cc_index_by_time', 'jsonl_loads',
-           'CC_PAGE_SIZE', 'query_cc_cdx_num_pages', 'query_cc_cdx_page', 'CC_API_FILTER_BLACKLIST', 'fetch_cc',
-           'CC_DATA_URL', 'CommonCrawlRecord', 'CommonCrawlQuery', 'cc_fetch_parallel']
+           'get_warc_digest', 'WarcFileQuery', 'warc_index_path', 'write_warc_index', 'read_warc_index', 'CDXJ_SUFFIX',
+           'read_warc_contents', 'warc_fetch_parallel', 'WARC_SKIP_GAP', 'WarcDirectoryQuery',
+           'header_and_rows_to_dict', 'mimetypes_to_regex', 'query_wayback_cdx', 'IA_CDX_URL', 'CaptureIndexRecord',
+           'PayloadTooLarge', 'copy_limited', 'STREAM_CHUNK_SIZE', 'MAX_PAYLOAD_SIZE', 'wayback_url',
+           'fetch_wayback_content_stream', 'fetch_wayback_content', 'IA_WAYBACK_URL', 'WaybackRecord', 'WaybackQuery',
+           'wayback_fetch_parallel', 'cc_cache', 'get_cc_indexes', 'CC_INDEX_URL', 'CC_CACHE_PATH', 'CC_CACHE_TTL',
+           'parse_cc_crawl_date', 'CrawlDateIndex', 'cc_crawl_index', 'cc_index_by_time', 'jsonl_loads',
+           'jsonl_columns', 'CC_PAGE_SIZE', 'query_cc_cdx_num_pages', 'query_cc_cdx_page', 'CC_API_FILTER_BLACKLIST',
+           'fetch_cc_stream', 'fetch_cc', 'CC_DATA_URL', 'CommonCrawlRecord', 'query_cc_cdx_serial',
+           'query_cc_cdx_concurrent', 'CC_QUERY_THREADS', 'CommonCrawlQuery', 'CCRange', 'plan_cc_ranges',
+           'fetch_cc_range', 'CC_COALESCE_GAP', 'CC_COALESCE_SIZE', 'cc_fetch_parallel', 'CDXBatch']
 
 # Cell
 # Typing
 #nbdev_comment from __future__ import annotations # For Python <3.9
-from typing import Any, Callable, Generator, Optional, Union
-from collections.abc import Iterable
+from typing import TYPE_CHECKING, Any, Callable, Generator, Optional, Union
+from collections.abc import Container, Iterable
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from datetime import datetime
 
-import requests
-from requests.sessions import Session
 import json
 
-from warcio.recordloader import ArcWarcRecord
-import warcio
+from .util import sha1_digest, URL, make_session, default_controller, TTLCache
 
-from .util import sha1_digest, URL, make_session
+# requests, warcio, joblib, tqdm and IPython are imported where they're used, so worker processes start quickly
+if TYPE_CHECKING:
+    from requests.sessions import Session
+    from warcio.recordloader import ArcWarcRecord
 
 # Cell
+import dataclasses
+import sys
+
+_CDX_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+
+def _parse_cdx_timestamp(timestamp: str) -> datetime:
+    """Parse a YYYYmmddHHMMSS timestamp, several times faster than strptime"""
+    if len(timestamp) != 14 or not timestamp.isdigit():
+        return datetime.strptime(timestamp, _CDX_TIMESTAMP_FORMAT)
+    return datetime(int(timestamp[:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+                    int(timestamp[8:10]), int(timestamp[10:12]), int(timestamp[12:14]))
+
+def _encode_timestamp(timestamp: Union[datetime, str, int]) -> Union[datetime, int]:
+    """The timestamp as an int YYYYmmddHHMMSS, or a datetime if it can't be represented that way"""
+    if isinstance(timestamp, int):
+        return timestamp
+    if isinstance(timestamp, str):
+        if len(timestamp) == 14 and timestamp.isdigit():
+            return int(timestamp)
+        timestamp = _parse_cdx_timestamp(timestamp)
+    if timestamp.microsecond or timestamp.tzinfo is not None:
+        return timestamp
+    return int(f'{timestamp.year:04}{timestamp.month:02}{timestamp.day:02}'
+               f'{timestamp.hour:02}{timestamp.minute:02}{timestamp.second:02}')
+
+def _decode_timestamp(timestamp: Union[datetime, int]) -> datetime:
+    if not isinstance(timestamp, int):
+        return timestamp
+    date, time = divmod(timestamp, 1_000_000)
+    return datetime(date // 10_000, date // 100 % 100, date % 100, time // 10_000, time // 100 % 100, time % 100)
+
+def _timestamp_str(timestamp: Union[datetime, int]) -> str:
+    if isinstance(timestamp, int):
+        return str(timestamp)
+    return timestamp.strftime(_CDX_TIMESTAMP_FORMAT)
+
+
+class _CompactField:
+    """A dataclass field stored encoded in the slot _<name>, and decoded when accessed"""
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.slot = '_' + name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            # The dataclass field has no default
+            raise AttributeError(self.name)
+        return self.decode(getattr(instance, self.slot))
+
+    def __set__(self, instance, value):
+        object.__setattr__(instance, self.slot, self.encode(value))
 
+    @staticmethod
+    def encode(value):
+        return value
+
+    @staticmethod
+    def decode(value):
+        return value
+
+class _TimestampField(_CompactField):
+    encode = staticmethod(_encode_timestamp)
+    decode = staticmethod(_decode_timestamp)
+
+
+_interned = {}
+
+def _intern(value):
+    if type(value) is str:
+        return sys.intern(value)
+    if value is None:
+        return value
+    return _interned.setdefault(value, value)
+
+class _InternedField(_CompactField):
+    """A field, like a filename, that takes only a few distinct values across records"""
+    encode = staticmethod(_intern)
+
+
+def _compact_record(cls):
+    """Recreate the dataclass cls with __slots__, like dataclass(slots=True) in Python 3.10+
+
+    Fields declared with a _CompactField are stored in the underscore slot it manages."""
+    cls_dict = dict(cls.__dict__)
+    slots = []
+    for f in dataclasses.fields(cls):
+        attribute = cls_dict.get(f.name)
+        if isinstance(attribute, _CompactField):
+            slots.append(attribute.slot)
+        else:
+            slots.append(f.name)
+            # The default is kept by __init__
+            cls_dict.pop(f.name, None)
+    cls_dict['__slots__'] = tuple(slots)
+    cls_dict.pop('__dict__', None)
+    cls_dict.pop('__weakref__', None)
+    cls_dict['__reduce__'] = _reduce_record
+    cls_dict['__setstate__'] = _setstate_record
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+def _reduce_record(self):
+    # The slots are in the same order as the fields, and hold values __init__ accepts
+    return type(self), tuple(getattr(self, slot) for slot in self.__slots__)
+
+def _setstate_record(self, state):
+    """Load records pickled before they had __slots__, or before they had all their fields"""
+    if isinstance(state, tuple):
+        state = {**(state[0] or {}), **state[1]}
+    defaults = {}
+    for f in dataclasses.fields(type(self)):
+        if f.default is not dataclasses.MISSING:
+            defaults[f.name] = f.default
+        elif f.default_factory is not dataclasses.MISSING:
+            defaults[f.name] = f.default_factory()
+    for name, value in {**defaults, **state}.items():
+        object.__setattr__(self, name, value)
+
+# Cell
+
+@_compact_record
 @dataclass(frozen=True)
 class WarcFileRecord:
     url: str
-    timestamp: datetime
-    mime: str
+    timestamp: datetime = _TimestampField()
+    mime: str = _InternedField()
     status: int
-    path: Path
+    path: Path = _InternedField()
     offset: int
     digest: str
+    length: Optional[int] = None
+
+    # Relative cost of fetching content, used to pick a source for duplicate content
+    fetch_cost = 0
 
     def get_content(self):
+        import warcio
         with open(self.path, 'rb') as f:
             f.seek(self.offset)
             record = next(warcio.ArchiveIterator(f))
             return record.content_stream().read()
 
     def preview(self, filename):
+        from IPython.display import FileLink
         with open(filename, 'wb') as f:
             f.write(self.content)
         return FileLink(filename)
@@ -57,15 +188,6 @@ class WarcFileRecord:
     def content(self):
         return self.get_content()
 
-    # Potential improvement is to keep the file open across records
-    @staticmethod
-    def fetch_parallel(records, callback=None):
-        for r in records:
-            content = r.content
-            if callback is not None:
-                callback(r, content)
-            yield r.content
-
 def get_warc_url(record: ArcWarcRecord) -> str:
     return record.rec_headers.get_header('WARC-Target-URI')
 
@@ -87,28 +209,187 @@ def get_warc_digest(record: ArcWarcRecord) -> str:
     return digest[len(prefix):]
 
 class WarcFileQuery:
-    def __init__(self, path: Union[str, Path]) -> None:
+    def __init__(self, path: Union[str, Path], index: bool = False) -> None:
         self.path = Path(path)
+        self.index = index
 
-    def query(self) -> Generator[WarcRecord, None, None]:
+    def scan(self) -> list[WarcFileRecord]:
+        import warcio
         results = []
         with open(self.path, 'rb') as f:
             archive = warcio.ArchiveIterator(f)
             for record in archive:
                 if record.rec_type != 'response':
                     continue
-                warc_record = WarcFileRecord(url=get_warc_url(record),
-                                         timestamp=get_warc_timestamp(record),
-                                         mime = get_warc_mime(record),
-                                         status = get_warc_status(record),
-                                         digest = get_warc_digest(record),
+                url = get_warc_url(record)
+                timestamp = get_warc_timestamp(record)
+                mime = get_warc_mime(record)
+                status = get_warc_status(record)
+                digest = get_warc_digest(record)
+                # Need to read the record to know its length
+                archive.read_to_end(record)
+                warc_record = WarcFileRecord(url=url,
+                                         timestamp=timestamp,
+                                         mime = mime,
+                                         status = status,
+                                         digest = digest,
                                          offset = archive.get_record_offset(),
+                                         length = archive.get_record_length(),
                                          path = self.path)
-
-
                 results.append(warc_record)
         return results
 
+    def query(self) -> Generator[WarcRecord, None, None]:
+        if not self.index:
+            return self.scan()
+
+        results = read_warc_index(self.path)
+        if results is None:
+            results = self.scan()
+            try:
+                write_warc_index(self.path, results)
+            except OSError as e:
+                logging.warning(f'Could not write index for {self.path}: {e}')
+        return results
+
+# Cell
+import logging
+import os
+
+CDXJ_SUFFIX = '.cdxj'
+
+def warc_index_path(path: Union[str, Path]) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + CDXJ_SUFFIX)
+
+def _warc_file_meta(path: Path) -> dict[str, int]:
+    stat = path.stat()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def write_warc_index(path: Union[str, Path], records: Iterable[WarcFileRecord]) -> Path:
+    """Write a CDXJ index of records in the WARC at path, returning the index path"""
+    path = Path(path)
+    index_path = warc_index_path(path)
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('!meta 0 ' + json.dumps(_warc_file_meta(path)) + '\n')
+        for record in records:
+            timestamp = record.timestamp.strftime('%Y%m%d%H%M%S')
+            data = {'url': record.url, 'mime': record.mime, 'status': record.status,
+                    'digest': record.digest, 'offset': record.offset, 'length': record.length}
+            f.write(f'{record.url} {timestamp} {json.dumps(data)}\n')
+    os.replace(tmp_path, index_path)
+    return index_path
+
+def read_warc_index(path: Union[str, Path]) -> Optional[list[WarcFileRecord]]:
+    """Read the records from the index of the WARC at path, or None if there is no up to date index"""
+    path = Path(path)
+    index_path = warc_index_path(path)
+    if not index_path.exists():
+        return None
+
+    records = []
+    with open(index_path, encoding='utf-8') as f:
+        meta = next(f, '')
+        if not meta.startswith('!meta ') or json.loads(meta.split(' ', 2)[2]) != _warc_file_meta(path):
+            return None
+        for line in f:
+            key, timestamp, rest = line.split(' ', 2)
+            data = json.loads(rest)
+            records.append(WarcFileRecord(timestamp=datetime.strptime(timestamp, '%Y%m%d%H%M%S'),
+                                          path=path, **data))
+    return records
+
+# Cell
+import mmap
+from collections import defaultdict
+
+# Read forward to records at most this many bytes past the last one, instead of seeking
+WARC_SKIP_GAP = 64 * 1024
+
+def read_warc_contents(path: Union[str, Path], offsets: Iterable[int], max_gap: int = WARC_SKIP_GAP) -> dict[int, bytes]:
+    """Read the content of the records at offsets in the WARC at path in a single forward pass"""
+    import warcio
+    contents = {}
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        archive = None
+        for offset in sorted(set(offsets)):
+            # archive.offset is where the next record starts
+            if archive is None or not archive.offset <= offset <= archive.offset + max_gap:
+                data.seek(offset)
+                archive = warcio.ArchiveIterator(data)
+            record = next(archive)
+            while archive.offset < offset:
+                record = next(archive)
+            if archive.offset != offset:
+                raise ValueError(f'No record at offset {offset} in {path}')
+            contents[offset] = record.content_stream().read()
+            archive.read_to_end()
+    return contents
+
+def warc_fetch_parallel(items, threads=1, callback=None, max_gap=WARC_SKIP_GAP):
+    """Fetch the content of items, reading each file in one pass and different files in parallel threads"""
+    from joblib import delayed, Parallel
+    items = list(items)
+    offsets = defaultdict(list)
+    for item in items:
+        offsets[item.path].append(item.offset)
+
+    paths = list(offsets)
+    path_contents = Parallel(n_jobs=threads, prefer='threads')(delayed(read_warc_contents)(path, offsets[path], max_gap) for path in paths)
+    contents = dict(zip(paths, path_contents))
+
+    results = []
+    for item in items:
+        content = contents[item.path][item.offset]
+        if callback is not None:
+            callback(item, content)
+        results.append(content)
+    return results
+
+WarcFileRecord.fetch_parallel = warc_fetch_parallel
+
+# Cell
+import time
+
+def _scan_warc(path: Path, index: bool) -> tuple[Path, list[WarcFileRecord], float]:
+    start_time = time.perf_counter()
+    records = WarcFileQuery(path, index=index).query()
+    return path, records, time.perf_counter() - start_time
+
+@dataclass
+class WarcDirectoryQuery:
+    path: Union[str, Path]
+    pattern: str = '*.warc.gz'
+    # Scan files with this many processes; like progress_bar it doesn't change the results
+    workers: Optional[int] = field(default=None, repr=False, compare=False)
+    index: bool = False
+    progress_bar: bool = field(default=True, repr=False, compare=False)
+
+    @property
+    def paths(self) -> list[Path]:
+        return sorted(Path(self.path).glob(self.pattern))
+
+    def query_pages(self, skip=()) -> Generator[tuple[str, list[WarcFileRecord]], None, None]:
+        """Yield (path, records) for each file whose path isn't in skip"""
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        from tqdm.auto import tqdm
+        paths = [path for path in self.paths if str(path) not in skip]
+        sizes = {path: path.stat().st_size for path in paths}
+        with ProcessPoolExecutor(self.workers) as executor, \
+             tqdm(total=sum(sizes.values()), desc='scan', unit='B', unit_scale=True, disable=not self.progress_bar) as pbar:
+            futures = [executor.submit(_scan_warc, path, self.index) for path in paths]
+            for future in as_completed(futures):
+                path, records, seconds = future.result()
+                logging.info(f'Scanned {path}: {len(records)} records in {seconds:.2f}s '
+                             f'({len(records) / seconds:.0f} records/s, {sizes[path] / seconds / 1024**2:.1f} MB/s)')
+                pbar.update(sizes[path])
+                yield str(path), records
+
+    def query(self) -> Generator[WarcFileRecord, None, None]:
+        for _, records in self.query_pages():
+            yield from records
+
 # Cell
 def header_and_rows_to_dict(rows: Iterable[list[Any]]) -> list[dict[Any, Any]]:
     header = None
@@ -134,7 +415,7 @@ def query_wayback_cdx(url: str, start: Optional[str], end: Optional[str],
                       status_ok: bool = True,
                       mime: Optional[Union[str, Iterable[str]]] = None,
                       limit: Optional[int] = None, offset: Optional[int] = None,
-                      session: Optional[Session] = None) -> list[CaptureIndexRecord]:
+                      session: Optional[Session] = None, as_rows: bool = False) -> list[CaptureIndexRecord]:
     """Get references to Wayback Machine Captures for url.
 
     Queries the Internet Archive Capture Index (CDX) for url.
@@ -147,10 +428,12 @@ def query_wayback_cdx(url: str, start: Optional[str], end: Optional[str],
       * limit: Only return first limit records
       * offset: Skip the first offset records, combine with limit
       * session: Session to use when making requests
+      * as_rows: Return the header and rows as the API sends them, rather than a dict per capture
     Filters results between start and end inclusive, in format YYYYmmddHHMMSS or any substring
     (e.g. start="202001", end="202001" will get all captures in January 2020)
     """
     if session is None:
+        import requests
         session = requests
 
     params = {'url': url,
@@ -173,48 +456,96 @@ def query_wayback_cdx(url: str, start: Optional[str], end: Optional[str],
     params = {k:v for k,v in params.items() if v}
     response = session.get(IA_CDX_URL, params=params)
     response.raise_for_status()
-    return header_and_rows_to_dict(response.json())
+    rows = response.json()
+    return rows if as_rows else header_and_rows_to_dict(rows)
 
 # Cell
+from io import BytesIO
+
+# Read payloads in chunks of this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+# Default limit on the size of a record's content; None for no limit
+MAX_PAYLOAD_SIZE = None
+
+class PayloadTooLarge(ValueError):
+    pass
+
+def copy_limited(src, dest, max_size: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> int:
+    """Copy the file src into dest, returning the number of bytes, and raising PayloadTooLarge after max_size"""
+    size = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return size
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise PayloadTooLarge(f'Content is over {max_size} bytes')
+        dest.write(chunk)
+
+def _max_payload_size(max_payload_size: Optional[int]) -> Optional[int]:
+    return MAX_PAYLOAD_SIZE if max_payload_size is None else max_payload_size
+
+# Cell
+IA_WAYBACK_URL = 'http://web.archive.org/web/'
+
 def wayback_url(timestamp: str, url: str, wayback: bool = False) -> str:
     postfix = '' if wayback else 'id_'
-    return f'http://web.archive.org/web/{timestamp}{postfix}/{url}'
+    return f'{IA_WAYBACK_URL}{timestamp}{postfix}/{url}'
 
-def fetch_wayback_content(timestamp: str, url: str,
-                          session: Optional[Session] = None) -> Optional[bytes]:
+def fetch_wayback_content_stream(timestamp: str, url: str, dest, session: Optional[Session] = None,
+                                 max_payload_size: Optional[int] = None) -> Optional[int]:
+    """Write the content into the file dest, returning its size, or None if it's missing"""
     if session is None:
+        import requests
         session = requests
 
     url = wayback_url(timestamp, url)
-    response = session.get(url)
-    # Sometimes Internet Archive deletes records
-    if response.status_code == 404:
-        logging.warning(f'Missing {url}')
+    with session.get(url, stream=True) as response:
+        # Sometimes Internet Archive deletes records
+        if response.status_code == 404:
+            logging.warning(f'Missing {url}')
+            return None
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return copy_limited(response.raw, dest, max_payload_size)
+
+def fetch_wayback_content(timestamp: str, url: str,
+                          session: Optional[Session] = None, max_payload_size: Optional[int] = None) -> Optional[bytes]:
+    dest = BytesIO()
+    if fetch_wayback_content_stream(timestamp, url, dest, session, max_payload_size) is None:
         return None
-    response.raise_for_status()
-    return response.content
+    return dest.getvalue()
 
 # Cell
 
 _WAYBACK_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
 
+
+@_compact_record
 @dataclass(frozen=True)
 class WaybackRecord:
     url: str
-    timestamp: datetime
-    mime: str
+    timestamp: datetime = _TimestampField()
+    mime: str = _InternedField()
     status: Optional[int]
     digest: str
 
+    fetch_cost = 2
+
     def preview(self) -> URL:
         return URL(wayback_url(self.timestamp_str, self.url, wayback=True))
 
     @property
     def timestamp_str(self) -> str:
-        return self.timestamp.strftime(_WAYBACK_TIMESTAMP_FORMAT)
-
-    def get_content(self, session=None, callback=None) -> Optional[bytes]:
-        result = fetch_wayback_content(self.timestamp_str, self.url, session=None)
+        return _timestamp_str(self._timestamp)
+
+    def get_content(self, session=None, callback=None, max_payload_size=None) -> Optional[bytes]:
+        try:
+            result = fetch_wayback_content(self.timestamp_str, self.url, session=session,
+                                           max_payload_size=_max_payload_size(max_payload_size))
+        except PayloadTooLarge as e:
+            logging.warning(f'Skipping {self.url}: {e}')
+            result = None
         if callback is not None:
             callback(self, result)
         return result
@@ -230,7 +561,7 @@ class WaybackRecord:
 
 def _wayback_cdx_to_record(record: dict) -> WaybackRecord:
     return WaybackRecord(url = record['original'],
-                         timestamp = datetime.strptime(record['timestamp'], _WAYBACK_TIMESTAMP_FORMAT),
+                         timestamp = record['timestamp'],
                          mime = record['mimetype'],
                          status = None if record['statuscode'] == '-' else int(record['statuscode']),
                          digest = record['digest'])
@@ -250,25 +581,59 @@ class WaybackQuery:
         for r in query_wayback_cdx(self.url, self.start, self.end, self.status_ok, self.mime, limit, session=session):
             yield _wayback_cdx_to_record(r)
 
-# Cell
+    def query_batches(self,
+                      limit: Optional[int] = None,
+                      session: Optional[Session] = None) -> Generator[CDXBatch, None, None]:
+        """Yield the captures as a CDXBatch"""
+        rows = query_wayback_cdx(self.url, self.start, self.end, self.status_ok, self.mime, limit, session=session, as_rows=True)
+        yield CDXBatch.from_rows(WaybackRecord, rows)
 
-from joblib import delayed, Parallel
+# Cell
 
-def wayback_fetch_parallel(items, threads=8, session=None, callback=None):
+def wayback_fetch_parallel(items, threads=8, session=None, callback=None, controller=None, max_payload_size=None):
+    from joblib import delayed, Parallel
     if session is None:
-        session = make_session(threads)
-    return Parallel(n_jobs=threads, prefer='threads')(delayed(item.get_content)(session=session, callback=callback) for item in items)
+        session = make_session(threads, controller=controller or default_controller())
+    return Parallel(n_jobs=threads, prefer='threads')(delayed(item.get_content)(session=session, callback=callback, max_payload_size=max_payload_size) for item in items)
 
 WaybackRecord.fetch_parallel = wayback_fetch_parallel
 
 # Cell
+import os
 from functools import lru_cache
-@lru_cache(maxsize=None)
-def get_cc_indexes() -> List[Dict[str, str]]:
-    response = requests.get("https://index.commoncrawl.org/collinfo.json")
+
+CC_INDEX_URL = 'https://index.commoncrawl.org/'
+
+# Where the list of indexes and the number of pages of queries are kept between runs; None to not keep them
+CC_CACHE_PATH = Path(os.environ.get('WEBREFINE_CACHE_DIR', Path.home() / '.cache' / 'webrefine')) / 'commoncrawl.sqlite'
+# Seconds to keep them for; a new crawl is added about once a month
+CC_CACHE_TTL = 24 * 60 * 60
+
+_cc_caches = {}
+
+def cc_cache() -> Optional[TTLCache]:
+    """The cache at CC_CACHE_PATH, or None if that's None"""
+    if CC_CACHE_PATH is None:
+        return None
+    key = (Path(CC_CACHE_PATH), CC_CACHE_TTL)
+    if key not in _cc_caches:
+        _cc_caches[key] = TTLCache(*key)
+    return _cc_caches[key]
+
+def _cc_cached(key: str, func: Callable[[], Any]) -> Any:
+    cache = cc_cache()
+    return func() if cache is None else cache.cached(key, func)
+
+def _fetch_cc_indexes() -> List[Dict[str, str]]:
+    import requests
+    response = requests.get(CC_INDEX_URL + 'collinfo.json')
     response.raise_for_status()
     return response.json()
 
+@lru_cache(maxsize=None)
+def get_cc_indexes() -> List[Dict[str, str]]:
+    return _cc_cached(f'collinfo\t{CC_INDEX_URL}', _fetch_cc_indexes)
+
 # Cell
 import re
 def parse_cc_crawl_date(crawl_id: str) -> datetime:
@@ -282,35 +647,73 @@ def parse_cc_crawl_date(crawl_id: str) -> datetime:
         raise ValueError(f'Unexpected id: {crawl_id}')
 
 # Cell
+import bisect
+
+class CrawlDateIndex:
+    """Crawl ids sorted by their approximate date, to find those that may have captures in a time range"""
+    def __init__(self, crawl_ids: Iterable[str]):
+        crawls = sorted((parse_cc_crawl_date(crawl_id), position, crawl_id) for position, crawl_id in enumerate(crawl_ids))
+        self.dates = [date for date, _, _ in crawls]
+        self._crawls = [(position, crawl_id) for _, position, crawl_id in crawls]
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def between(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> list[str]:
+        """Crawl ids, in their original order, from the last crawl before start to the first crawl after end"""
+        if start and end and end < start:
+            raise ValueError(f"Expect start >= end: start={start}, end={end}")
+        if not self.dates:
+            return []
+
+        # The last crawl before start, or else the first crawl
+        previous_date = self.dates[max(bisect.bisect_left(self.dates, start) - 1, 0)] if start else self.dates[0]
+        # The first crawl after end, or else the last crawl
+        next_date = self.dates[min(bisect.bisect_right(self.dates, end), len(self.dates) - 1)] if end else self.dates[-1]
+
+        lo = bisect.bisect_left(self.dates, previous_date)
+        hi = bisect.bisect_right(self.dates, next_date)
+        return [crawl_id for _, crawl_id in sorted(self._crawls[lo:hi])]
+
+@lru_cache(maxsize=16)
+def _crawl_date_index(crawl_ids: tuple[str, ...]) -> CrawlDateIndex:
+    return CrawlDateIndex(crawl_ids)
+
+def cc_crawl_index() -> CrawlDateIndex:
+    """CrawlDateIndex of the Common Crawl indexes, only built again when they change"""
+    return _crawl_date_index(tuple(i['id'] for i in get_cc_indexes()))
+
 def cc_index_by_time(start:Optional[datetime]=None, end:Optional[datetime]=None, indexes:Optional[list[str]]=None) -> list[str]:
     """Gets all indexes that may contain entries between start and end
 
     Generally errs on the side of giving an additional index"""
-    if indexes is None:
-        indexes = [i['id'] for i in get_cc_indexes()]
-
-    if start and end and end < start:
-        raise ValueError(f"Expect start >= end: start={start}, end={end}")
-
-
-    dates = [parse_cc_crawl_date(i) for i in indexes]
-    if start:
-        previous_date = max((ts for ts in dates if ts < start), default=min(dates))
-    else:
-        previous_date = min(dates)
-
-    if end:
-        next_date = min((ts for ts in dates if ts > end), default=max(dates))
-    else:
-        next_date = max(dates)
-
-    return [i for i in indexes if previous_date <= parse_cc_crawl_date(i) <= next_date]
+    crawl_index = cc_crawl_index() if indexes is None else _crawl_date_index(tuple(indexes))
+    return crawl_index.between(start, end)
 
 # Cell
 import json
 
+def _jsonl_array(jsonl) -> bytes:
+    # Parsing all the lines as one array is much faster than parsing each line
+    if isinstance(jsonl, str):
+        jsonl = jsonl.encode('utf-8')
+    lines = [line for line in jsonl.splitlines() if line.strip()]
+    return b'[' + b','.join(lines) + b']'
+
 def jsonl_loads(jsonl):
-    return [json.loads(line) for line in jsonl.splitlines()]
+    return json.loads(_jsonl_array(jsonl))
+
+def jsonl_columns(jsonl, keys: Iterable[str]) -> dict[str, list]:
+    """A list of the values of each of keys in the objects of jsonl, with None where an object doesn't have it"""
+    columns = {key: [] for key in keys}
+    appends = [(key, column.append) for key, column in columns.items()]
+    def append_row(pairs):
+        # Each object is appended to the columns and dropped, rather than kept as a dict
+        row = dict(pairs)
+        for key, append in appends:
+            append(row.get(key))
+    json.loads(_jsonl_array(jsonl), object_pairs_hook=append_row)
+    return columns
 
 # Cell
 
@@ -319,9 +722,9 @@ CC_PAGE_SIZE = 5
 
 # Cell
 
-def query_cc_cdx_num_pages(api: str,  url: str, page_size: int = CC_PAGE_SIZE,
-                           session: Optional[Session] = None) -> int:
+def _fetch_cc_cdx_num_pages(api: str,  url: str, page_size: int, session: Optional[Session]) -> int:
     if session is None:
+        import requests
         session = requests
 
     response = session.get(api, params=dict(url=url, output='json',
@@ -331,13 +734,20 @@ def query_cc_cdx_num_pages(api: str,  url: str, page_size: int = CC_PAGE_SIZE,
     data = response.json()
     return data["pages"]
 
+def query_cc_cdx_num_pages(api: str,  url: str, page_size: int = CC_PAGE_SIZE,
+                           session: Optional[Session] = None) -> int:
+    """Number of pages of results for url from api, kept in the cc_cache"""
+    return _cc_cached(f'num_pages\t{api}\t{url}\t{page_size}',
+                      lambda: _fetch_cc_cdx_num_pages(api, url, page_size, session))
+
 def query_cc_cdx_page(
                  api: str, url: str, page: int,
                  start: Optional[str] = None, end: Optional[str] = None,
                  status_ok: bool = True, mime: Optional[Union[str, Iterable[str]]] = None,
                  limit: Optional[int] = None, offset: Optional[int] = None,
                  page_size: int = CC_PAGE_SIZE,
-                 session: Optional[Session] = None) -> List[CaptureIndexRecord]:
+                 session: Optional[Session] = None,
+                 parse: Callable[[bytes], Any] = jsonl_loads) -> List[CaptureIndexRecord]:
     """Get references to Common Crawl Captures for url.
 
     Queries the Common Crawl Capture Index (CDX) for url.
@@ -351,10 +761,12 @@ def query_cc_cdx_page(
       * limit: Only return first limit records
       * offset: Skip the first offset records, combine with limit
       * session: Session to use when making requests
+      * parse: Function to parse the JSON lines of the response with, a list of dicts by default
     Filters results between start and end inclusive, in format YYYYmmddHHMMSS or any substring
     (e.g. start="202001", end="202001" will get all captures in January 2020)
     """
     if session is None:
+        import requests
         session = requests
 
     params = {'url': url,
@@ -381,63 +793,88 @@ def query_cc_cdx_page(
     params = {k:v for k,v in params.items() if v}
     response = session.get(api, params=params)
     response.raise_for_status()
-    return jsonl_loads(response.content)
+    return parse(response.content)
 
 # Cell
 CC_API_FILTER_BLACKLIST = ['CC-MAIN-2015-11', 'CC-MAIN-2015-06']
 
 # Cell
-from warcio import ArchiveIterator
-from io import BytesIO
-
 CC_DATA_URL = "https://data.commoncrawl.org/"
-def fetch_cc(filename: str, offset: int, length: int, session: Optional[Session] = None) -> bytes:
-    if session is None:
-        session = requests
+
+def _cc_range_request(filename: str, offset: int, length: int) -> tuple[str, dict[str, str]]:
     data_url = CC_DATA_URL + filename
     start_byte = int(offset)
     end_byte = start_byte + int(length)
     headers = {"Range": f"bytes={start_byte}-{end_byte}"}
-    r = session.get(data_url, headers=headers)
-    r.raise_for_status()
+    return data_url, headers
 
-    # Decord WARC
-    response_content = r.content
-    archive = ArchiveIterator(BytesIO(response_content))
+def _decode_cc_warc_stream(stream, dest, max_payload_size: Optional[int] = None) -> int:
+    from warcio import ArchiveIterator
+    archive = ArchiveIterator(stream)
     record = next(archive)
-    content = record.content_stream().read()
+    size = copy_limited(record.content_stream(), dest, max_payload_size)
 
     # Archive should have just 1 record
     assert not any(True for _ in archive), "Expected 1 result in archive"
 
-    return content
+    return size
+
+def _decode_cc_warc(response_content: bytes, max_payload_size: Optional[int] = None) -> bytes:
+    dest = BytesIO()
+    _decode_cc_warc_stream(BytesIO(response_content), dest, max_payload_size)
+    return dest.getvalue()
+
+def fetch_cc_stream(filename: str, offset: int, length: int, dest, session: Optional[Session] = None,
+                    max_payload_size: Optional[int] = None) -> int:
+    """Decode the content from the response as it arrives into the file dest, returning its size"""
+    if session is None:
+        import requests
+        session = requests
+    data_url, headers = _cc_range_request(filename, offset, length)
+    with session.get(data_url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        return _decode_cc_warc_stream(r.raw, dest, max_payload_size)
+
+def fetch_cc(filename: str, offset: int, length: int, session: Optional[Session] = None,
+             max_payload_size: Optional[int] = None) -> bytes:
+    dest = BytesIO()
+    fetch_cc_stream(filename, offset, length, dest, session, max_payload_size)
+    return dest.getvalue()
 
 # Cell
 _CC_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
-from IPython.display import FileLink
 
+@_compact_record
 @dataclass(frozen=True)
 class CommonCrawlRecord:
     url: str
-    timestamp: datetime
-    filename: str
+    timestamp: datetime = _TimestampField()
+    filename: str = _InternedField()
     offset: int
     length: int
-    mime: Optional[str]
+    mime: Optional[str] = _InternedField()
     status: Optional[int]
     digest: Optional[str]
 
+    fetch_cost = 1
+
     def preview(self, filename):
+        from IPython.display import FileLink
         with open(filename, 'wb') as f:
             f.write(self.content)
         return FileLink(filename)
 
     @property
     def timestamp_str(self) -> str:
-        return self.timestamp.strftime(_CC_TIMESTAMP_FORMAT)
-
-    def get_content(self, session=None, callback=None) -> Optional[bytes]:
-        result = fetch_cc(self.filename, self.offset, self.length, session=session)
+        return _timestamp_str(self._timestamp)
+
+    def get_content(self, session=None, callback=None, max_payload_size=None) -> Optional[bytes]:
+        try:
+            result = fetch_cc(self.filename, self.offset, self.length, session=session,
+                              max_payload_size=_max_payload_size(max_payload_size))
+        except PayloadTooLarge as e:
+            logging.warning(f'Skipping {self.url}: {e}')
+            result = None
         if callback is not None:
             callback(self, result)
         return result
@@ -454,7 +891,7 @@ class CommonCrawlRecord:
 def _cc_cdx_to_record(record: dict) -> CommonCrawlRecord:
     return CommonCrawlRecord(
          url = record['url'],
-         timestamp = datetime.strptime(record['timestamp'], _CC_TIMESTAMP_FORMAT),
+         timestamp = record['timestamp'],
          offset=record['offset'],
          length=record['length'],
          filename=record['filename'],
@@ -462,6 +899,69 @@ def _cc_cdx_to_record(record: dict) -> CommonCrawlRecord:
          status = None if record.get('status', '-') == '-' else int(record['status']),
          digest = record.get('digest'))
 
+# Cell
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Default number of concurrent requests to the Common Crawl index
+CC_QUERY_THREADS = 8
+
+def _query_cc_api_page(api_id: str, api: str, url: str, page: int,
+                       status_ok: bool = True, mime: Optional[Union[str, Iterable[str]]] = None,
+                       page_size: int = CC_PAGE_SIZE, session: Optional[Session] = None,
+                       parse: Callable[[bytes], Any] = jsonl_loads) -> list[CaptureIndexRecord]:
+    if api_id not in CC_API_FILTER_BLACKLIST:
+        return query_cc_cdx_page(api, url, page, page_size=page_size, status_ok=status_ok, mime=mime, session=session, parse=parse)
+    else:
+        # Deal with missing Status OK and Mime
+        return query_cc_cdx_page(api, url, page, page_size=page_size, status_ok=False, mime=None, session=session, parse=parse)
+
+def query_cc_cdx_serial(apis: dict[str, str], url: str,
+                        status_ok: bool = True, mime: Optional[Union[str, Iterable[str]]] = None,
+                        page_size: int = CC_PAGE_SIZE, session: Optional[Session] = None,
+                        skip: Container[tuple[str, int]] = (),
+                        parse: Callable[[bytes], Any] = jsonl_loads) -> Generator[tuple[str, int, list[CaptureIndexRecord]], None, None]:
+    """Yield (api id, page, captures) for url from every page of apis, a mapping from crawl id to CDX API.
+
+    Pages where (api id, page) is in skip aren't requested, and each page is parsed with parse."""
+    for api_id, api in apis.items():
+        num_pages = query_cc_cdx_num_pages(api, url, page_size=page_size, session=session)
+        for page in range(num_pages):
+            if (api_id, page) not in skip:
+                yield api_id, page, _query_cc_api_page(api_id, api, url, page, status_ok=status_ok, mime=mime,
+                                                       page_size=page_size, session=session, parse=parse)
+
+def query_cc_cdx_concurrent(apis: dict[str, str], url: str,
+                            status_ok: bool = True, mime: Optional[Union[str, Iterable[str]]] = None,
+                            page_size: int = CC_PAGE_SIZE, threads: int = CC_QUERY_THREADS,
+                            session: Optional[Session] = None,
+                            skip: Container[tuple[str, int]] = (),
+                            parse: Callable[[bytes], Any] = jsonl_loads) -> Generator[tuple[str, int, list[CaptureIndexRecord]], None, None]:
+    """Like query_cc_cdx_serial, but pages are requested in parallel and yielded as they arrive."""
+    if session is None:
+        session = make_session(threads)
+
+    with ThreadPoolExecutor(threads) as executor:
+        # Map each future to its api id, api and page, where page is None for the number of pages
+        pending = {executor.submit(query_cc_cdx_num_pages, api, url, page_size=page_size, session=session): (api_id, api, None)
+                   for api_id, api in apis.items()}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    api_id, api, page = pending.pop(future)
+                    if page is None:
+                        for page in range(future.result()):
+                            if (api_id, page) in skip:
+                                continue
+                            page_future = executor.submit(_query_cc_api_page, api_id, api, url, page, status_ok=status_ok,
+                                                          mime=mime, page_size=page_size, session=session, parse=parse)
+                            pending[page_future] = (api_id, api, page)
+                    else:
+                        yield api_id, page, future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
 # Cell
 import logging
 
@@ -475,38 +975,241 @@ class CommonCrawlQuery:
     apis: Optional[list[str]] = None
     status_ok: bool = True
     mime: Optional[Union[str, Iterable[str]]] = None
+    # Query pages concurrently with this many threads; doesn't change the results
+    threads: Optional[int] = field(default=None, repr=False, compare=False)
 
     @property
     def cdx_apis(self) -> Dict[str, str]:
         all_apis = get_cc_indexes()
         if self.apis is None:
-            apis = cc_index_by_time(self.start, self.end)
+            apis = set(cc_index_by_time(self.start, self.end))
         else:
-            apis = self.apis
+            apis = set(self.apis)
 
         return {x['id']: x['cdx-api'] for x in all_apis if x['id'] in apis}
 
-    def query(self, page_size=CC_PAGE_SIZE, session=None) -> Generator[CommonCrawlRecord, None, None]:
-        for api_id, api in self.cdx_apis.items():
-            num_pages = query_cc_cdx_num_pages(api, self.url, page_size=page_size, session=session)
+    def _cdx_pages(self, skip, page_size, session, threads, parse=jsonl_loads):
+        threads = threads or self.threads
+        if threads:
+            return query_cc_cdx_concurrent(self.cdx_apis, self.url, status_ok=self.status_ok, mime=self.mime,
+                                           page_size=page_size, threads=threads, session=session, skip=skip, parse=parse)
+        return query_cc_cdx_serial(self.cdx_apis, self.url, status_ok=self.status_ok, mime=self.mime,
+                                   page_size=page_size, session=session, skip=skip, parse=parse)
+
+    def query_pages(self, skip=(), page_size=CC_PAGE_SIZE, session=None, threads=None) -> Generator[tuple[tuple[str, int], list[CommonCrawlRecord]], None, None]:
+        """Yield ((crawl id, page), records) for each page of results whose key isn't in skip"""
+        for api_id, page, results_page in self._cdx_pages(skip, page_size, session, threads):
+            yield (api_id, page), [_cc_cdx_to_record(result) for result in results_page]
+
+    def query(self, page_size=CC_PAGE_SIZE, session=None, threads=None) -> Generator[CommonCrawlRecord, None, None]:
+        for _, records in self.query_pages(page_size=page_size, session=session, threads=threads):
+            yield from records
+
+    def query_batches(self, page_size=CC_PAGE_SIZE, session=None, threads=None) -> Generator[CDXBatch, None, None]:
+        """Yield the captures of each page of results as a CDXBatch"""
+        # Parse the captures straight into columns, without a dict for each
+        parse = lambda jsonl: CDXBatch.from_jsonl(CommonCrawlRecord, jsonl)
+        for _, _, batch in self._cdx_pages((), page_size, session, threads, parse=parse):
+            yield batch
 
-            for page in range(num_pages):
-                if api_id not in CC_API_FILTER_BLACKLIST:
-                    results_page = query_cc_cdx_page(api, self.url, page, page_size=page_size, status_ok=self.status_ok, mime=self.mime, session=session)
-                else:
-                    # Deal with missing Status OK and Mime
-                    results_page = query_cc_cdx_page(api, self.url, page, page_size=page_size, status_ok=False, mime=None, session=session)
+# Cell
+from collections import defaultdict
 
-                for result in results_page:
-                    yield _cc_cdx_to_record(result)
+# Merge records that are at most this many bytes apart
+CC_COALESCE_GAP = 64 * 1024
+# Largest merged range request
+CC_COALESCE_SIZE = 8 * 1024 * 1024
 
-# Cell
-from joblib import delayed, Parallel
+@dataclass
+class CCRange:
+    """A range request that covers records; positions are their indices in the planned batch"""
+    filename: str
+    start: int
+    end: int
+    records: list[CommonCrawlRecord]
+    positions: list[int]
+
+def plan_cc_ranges(records: Iterable[CommonCrawlRecord],
+                   max_gap: int = CC_COALESCE_GAP, max_size: int = CC_COALESCE_SIZE) -> list[CCRange]:
+    """Group records into range requests, merging nearby records in the same file"""
+    by_filename = defaultdict(list)
+    for position, record in enumerate(records):
+        by_filename[record.filename].append((int(record.offset), position, record))
+
+    ranges = []
+    for filename, items in by_filename.items():
+        current = None
+        for offset, position, record in sorted(items, key=lambda x: x[:2]):
+            end = offset + int(record.length)
+            if (current is not None and offset - current.end <= max_gap
+                and max(end, current.end) - current.start <= max_size):
+                current.end = max(end, current.end)
+            else:
+                current = CCRange(filename, offset, end, [], [])
+                ranges.append(current)
+            current.records.append(record)
+            current.positions.append(position)
+    return ranges
+
+def _read_cc_range(stream, cc_range: CCRange, max_payload_size: Optional[int] = None) -> list[Optional[bytes]]:
+    """Decode the records of cc_range from the stream of its response, one WARC record at a time"""
+    from warcio import ArchiveIterator
+    indices = defaultdict(list)
+    for index, record in enumerate(cc_range.records):
+        indices[int(record.offset) - cc_range.start].append(index)
+
+    contents = [None] * len(cc_range.records)
+    archive = ArchiveIterator(stream)
+    for warc_record in archive:
+        offset = archive.offset
+        if offset not in indices:
+            continue
+        record_indices = indices.pop(offset)
+        dest = BytesIO()
+        try:
+            copy_limited(warc_record.content_stream(), dest, max_payload_size)
+        except PayloadTooLarge as e:
+            logging.warning(f'Skipping {cc_range.records[record_indices[0]].url}: {e}')
+            continue
+        for index in record_indices:
+            contents[index] = dest.getvalue()
+    if indices:
+        # Otherwise their content would be cached as missing
+        missing = [cc_range.records[index].url for offset_indices in indices.values() for index in offset_indices]
+        raise ValueError(f'No record at offsets {sorted(indices)} of range {cc_range.start}-{cc_range.end} '
+                         f'in {cc_range.filename} for {missing}')
+    return contents
+
+def fetch_cc_range(cc_range: CCRange, session: Optional[Session] = None,
+                   callback: Optional[Callable] = None, max_payload_size: Optional[int] = None) -> list[Optional[bytes]]:
+    """Fetch the content of every record in cc_range with a single request, decoding it as it arrives"""
+    if session is None:
+        import requests
+        session = requests
+    data_url = CC_DATA_URL + cc_range.filename
+    headers = {"Range": f"bytes={cc_range.start}-{cc_range.end - 1}"}
+    with session.get(data_url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise ValueError(f'Expected a partial response from {data_url} for {headers["Range"]}, got status {r.status_code}')
+        contents = _read_cc_range(r.raw, cc_range, _max_payload_size(max_payload_size))
+
+    if callback is not None:
+        for record, content in zip(cc_range.records, contents):
+            callback(record, content)
+    return contents
 
+# Cell
+def cc_fetch_parallel(items, threads=32, session=None, callback=None,
+                      max_gap=CC_COALESCE_GAP, max_size=CC_COALESCE_SIZE, controller=None, max_payload_size=None):
+    """Fetch the content of items in parallel, coalescing nearby range requests
 
-def cc_fetch_parallel(items, threads=32, session=None, callback=None):
+    Set max_gap to None to make one request per item."""
+    from joblib import delayed, Parallel
     if session is None:
-        session = make_session(threads)
-    return Parallel(n_jobs=threads, prefer='threads')(delayed(item.get_content)(session=session, callback=callback) for item in items)
+        session = make_session(threads, controller=controller or default_controller())
+    if max_gap is None:
+        return Parallel(n_jobs=threads, prefer='threads')(delayed(item.get_content)(session=session, callback=callback, max_payload_size=max_payload_size) for item in items)
 
-CommonCrawlRecord.fetch_parallel = cc_fetch_parallel
\ No newline at end of file
+    items = list(items)
+    cc_ranges = plan_cc_ranges(items, max_gap=max_gap, max_size=max_size)
+    range_contents = Parallel(n_jobs=threads, prefer='threads')(delayed(fetch_cc_range)(cc_range, session=session, callback=callback, max_payload_size=max_payload_size) for cc_range in cc_ranges)
+
+    contents = [None] * len(items)
+    for cc_range, range_content in zip(cc_ranges, range_contents):
+        for position, content in zip(cc_range.positions, range_content):
+            contents[position] = content
+    return contents
+
+CommonCrawlRecord.fetch_parallel = cc_fetch_parallel
+
+# Cell
+import itertools
+
+# The CDX field each field of a record comes from
+_CDX_FIELDS = {
+    WaybackRecord: dict(url='original', timestamp='timestamp', mime='mimetype', status='statuscode', digest='digest'),
+    CommonCrawlRecord: dict(url='url', timestamp='timestamp', filename='filename', offset='offset', length='length',
+                            mime='mime', status='status', digest='digest'),
+}
+
+def _parse_status_column(statuses: list) -> list[Optional[int]]:
+    return [None if status is None or status == '-' else int(status) for status in statuses]
+
+@dataclass
+class CDXBatch:
+    """Captures as a column for each field of record_type, a WaybackRecord or CommonCrawlRecord
+
+    Timestamps are kept as the CDX strings, which the records decode when they are accessed."""
+    record_type: type
+    columns: dict[str, list]
+
+    @classmethod
+    def from_rows(cls, record_type: type, rows: list[list]) -> CDXBatch:
+        """From a header row followed by rows, as returned by the Internet Archive CDX API"""
+        fields = _CDX_FIELDS[record_type]
+        if not rows:
+            return cls(record_type, {field: [] for field in fields})
+        header, data = rows[0], rows[1:]
+        cdx_columns = dict(zip(header, map(list, zip(*data)))) if data else {}
+        return cls._from_cdx_columns(record_type, cdx_columns, len(data))
+
+    @classmethod
+    def from_jsonl(cls, record_type: type, jsonl: Union[str, bytes]) -> CDXBatch:
+        """From JSON lines with an object for each capture, as returned by the Common Crawl CDX API"""
+        cdx_columns = jsonl_columns(jsonl, _CDX_FIELDS[record_type].values())
+        return cls._from_cdx_columns(record_type, cdx_columns, len(next(iter(cdx_columns.values()))))
+
+    @classmethod
+    def from_dicts(cls, record_type: type, rows: list[dict]) -> CDXBatch:
+        """From a dict for each capture, as returned by the Common Crawl CDX API"""
+        cdx_columns = {cdx_field: [row.get(cdx_field) for row in rows] for cdx_field in _CDX_FIELDS[record_type].values()}
+        return cls._from_cdx_columns(record_type, cdx_columns, len(rows))
+
+    @classmethod
+    def _from_cdx_columns(cls, record_type: type, cdx_columns: dict[str, list], size: int) -> CDXBatch:
+        columns = {field: cdx_columns.get(cdx_field, [None] * size) for field, cdx_field in _CDX_FIELDS[record_type].items()}
+        columns['status'] = _parse_status_column(columns['status'])
+        return cls(record_type, columns)
+
+    @classmethod
+    def concat(cls, batches: Iterable[CDXBatch]) -> CDXBatch:
+        batches = list(batches)
+        if not batches:
+            raise ValueError('Need at least one batch to concatenate')
+        return cls(batches[0].record_type, {field: list(itertools.chain.from_iterable(b.columns[field] for b in batches))
+                                            for field in batches[0].columns})
+
+    def __len__(self) -> int:
+        return len(self.columns['url'])
+
+    def __iter__(self) -> Generator[Any, None, None]:
+        return self.records()
+
+    def take(self, indices: Iterable[int]) -> CDXBatch:
+        indices = list(indices)
+        return CDXBatch(self.record_type, {field: [column[i] for i in indices] for field, column in self.columns.items()})
+
+    def filter(self, mask: Iterable[bool]) -> CDXBatch:
+        """The captures where mask is true"""
+        mask = list(mask)
+        return CDXBatch(self.record_type, {field: list(itertools.compress(column, mask)) for field, column in self.columns.items()})
+
+    def where(self, field: str, predicate: Callable[[Any], bool]) -> CDXBatch:
+        return self.filter(map(predicate, self.columns[field]))
+
+    def dedup_by_digest(self) -> CDXBatch:
+        """Keep the first capture with each digest"""
+        first = {}
+        for i, digest in enumerate(self.columns['digest']):
+            first.setdefault(digest, i)
+        return self.take(sorted(first.values()))
+
+    def records(self) -> Generator[Any, None, None]:
+        fields = list(self.columns)
+        for values in zip(*self.columns.values()):
+            yield self.record_type(**dict(zip(fields, values)))
+
+    def to_arrow(self):
+        import pyarrow
+        return pyarrow.table(self.columns)
\ No newline at end of file
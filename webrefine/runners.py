@@ -4,12 +4,17 @@
 from __future__ import annotations
 
 
-__all__ = ['Process', 'RunnerMemory', 'minibatch', 'compress_encode', 'compress_decode', 'RunnerCached']
+__all__ = ['Process', 'transform_parallel', 'RunnerMemory', 'IdentityCodec', 'ZlibCodec', 'ZstdCodec', 'make_codec',
+           'encode_payload', 'decode_payload', 'ZSTD_DICT_SIZE', 'CODECS', 'ShardedSqliteDict', 'BlobStore',
+           'minibatch', 'compress_encode', 'compress_decode', 'dedup_by_digest', 'RunnerCached', 'records_to_table',
+           'table_to_records', 'step_version', 'step_keys', 'LeaseQueue', 'run_fetch_workers']
 
 # Cell
 #nbdev_comment from __future__ import annotations
 from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Mapping, Optional, Sequence, Union
+
+from .metrics import Metrics, StepProfiler
 
 
 
@@ -23,45 +28,383 @@ class Process:
     steps: list[Callable]
     filter: Callable
 
+# Cell
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import cProfile
+import time
+import tracemalloc
+
+def _reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        # Before Python 3.9 restarting is the only way to reset the peak
+        limit = tracemalloc.get_traceback_limit()
+        tracemalloc.stop()
+        tracemalloc.start(limit)
+
+def _run_steps(steps, content, record, timings=None, memory=False):
+    """Run steps on content, appending (step name, seconds, peak bytes allocated if memory) for each to timings"""
+    for step in steps:
+        if memory:
+            _reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            content = step(content, record)
+        except Exception as e:
+            logging.error('Error processing %s at step %s: %s' % (record, step.__name__, e))
+            return False, None
+        finally:
+            if timings is not None:
+                timings.append((step.__name__, time.perf_counter() - start,
+                                tracemalloc.get_traced_memory()[1] - allocated if memory else None))
+    return True, content
+
+class _StepProfile:
+    """Trace memory allocations while running steps, and run them under cProfile if profile"""
+    def __init__(self, memory=False, profile=False):
+        self.memory = memory
+        self.profile = cProfile.Profile() if profile else None
+        self.stats = None
+
+    def __enter__(self):
+        self._started = self.memory and not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.create_stats()
+            self.stats = self.profile.stats
+        if self._started:
+            tracemalloc.stop()
+
+def _run_steps_profiled(steps, content, record, memory=False, profile=False):
+    timings = []
+    with _StepProfile(memory, profile) as step_profile:
+        ok, content = _run_steps(steps, content, record, timings, memory)
+    return ok, content, record, timings, step_profile.stats
+
+def _record_timings(record, timings, stats, metrics=None, profiler=None):
+    for step, seconds, memory in timings:
+        if metrics is not None:
+            metrics.observe('step_seconds', seconds, step=step)
+        if profiler is not None:
+            profiler.record(step, seconds, memory, record)
+    if stats is not None:
+        profiler.add_stats(stats)
+
+def _pop_completed(pending, ordered):
+    if ordered:
+        return [pending.popleft()]
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+    return done
+
+def _map(func, args, workers=None, ordered=True):
+    """Yield func(*arg) for each arg, in a pool of worker processes if workers is set"""
+    if not workers:
+        for arg in args:
+            yield func(*arg)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        try:
+            for arg in args:
+                pending.append(executor.submit(func, *arg))
+                while len(pending) >= 2 * workers:
+                    for future in _pop_completed(pending, ordered):
+                        yield future.result()
+            while pending:
+                for future in _pop_completed(pending, ordered):
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+def transform_parallel(content_records, steps, workers, ordered=True, metrics: Optional[Metrics] = None,
+                       profiler: Optional[StepProfiler] = None):
+    """Apply steps to each (content, record) in a pool of worker processes, yielding the results.
+
+    With ordered=False results are yielded as soon as they are ready, rather than in input order."""
+    if metrics is None and profiler is None:
+        args = ((steps, content, record) for content, record in content_records)
+        for ok, content in _map(_run_steps, args, workers, ordered):
+            if ok:
+                yield content
+        return
+
+    memory = profiler is not None and profiler.memory
+    args = ((steps, content, record, memory, profiler is not None and profiler.sample())
+            for content, record in content_records)
+    for ok, content, record, timings, stats in _map(_run_steps_profiled, args, workers, ordered):
+        _record_timings(record, timings, stats, metrics, profiler)
+        if ok:
+            yield content
+
 # Cell
 
 class RunnerMemory():
-    def __init__(self, process: Process, progress_bar: bool = True):
+    def __init__(self, process: Process, progress_bar: bool = True, concurrency: Optional[int] = None,
+                 workers: Optional[int] = None, ordered: bool = True, metrics: Optional[Metrics] = None,
+                 profiler: Optional[StepProfiler] = None):
         self.process = process
         self.progress_bar = progress_bar
+        self.concurrency = concurrency
+        self.workers = workers
+        self.ordered = ordered
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler
 
     def query(self):
-        for query in tqdm(self.process.queries, desc='query', disable=not self.progress_bar):
-            for record in query.query():
-                yield record
+        queries = tqdm(self.process.queries, desc='query', disable=not self.progress_bar)
+        return self.metrics.timed((record for query in queries for record in query.query()), 'query')
 
     def prepare(self, records):
-        return self.process.filter(tqdm(records, desc='filter', disable=not self.progress_bar))
+        return self.metrics.timed(self.process.filter(tqdm(records, desc='filter', disable=not self.progress_bar)), 'filter')
 
     def fetch(self, records):
-        for record in tqdm(records, desc='fetch', disable=not self.progress_bar):
-            yield (record.content, record)
+        records = tqdm(records, desc='fetch', disable=not self.progress_bar)
+        if self.concurrency:
+            # Only import aiohttp when it's needed
+            from .aio import aio_fetch_parallel
+            content_records = aio_fetch_parallel(records, concurrency=self.concurrency)
+        else:
+            content_records = ((record.content, record) for record in records)
+        for content, record in self.metrics.timed(content_records, 'fetch'):
+            if content is not None:
+                self.metrics.count('fetch_bytes', len(content))
+            yield (content, record)
 
     def transform(self, content_records):
-        for content, record in tqdm(content_records, desc='transform', disable=not self.progress_bar):
-            error = False
-            for step in self.process.steps:
-                try:
-                    content = step(content, record)
-                except Exception as e:
-                    error = True
-                    logging.error('Error processing %s at step %s: %s' % (record, step.__name__, e))
-                    break
-            if not error:
-                yield content
+        content_records = tqdm(content_records, desc='transform', disable=not self.progress_bar)
+        return self.metrics.timed(transform_parallel(content_records, self.process.steps, self.workers, ordered=self.ordered,
+                                                     metrics=self.metrics, profiler=self.profiler), 'transform')
 
     def run(self):
         records = self.prepare(self.query())
         content_records = self.fetch(records)
         return self.transform(content_records)
 
+# Cell
+import sqlite3, zlib
+
+# Default size of trained zstd dictionaries
+ZSTD_DICT_SIZE = 110 * 1024
+
+class IdentityCodec:
+    name = 'none'
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+class ZstdCodec:
+    def __init__(self, dictionary: Optional[bytes] = None, dictionary_id: Optional[str] = None, level: int = 3):
+        # Only import zstandard when it's needed
+        import zstandard
+        self.name = 'zstd' if dictionary is None else f'zstd:{dictionary_id}'
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary is not None else None
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+CODECS = {'none': IdentityCodec, 'zlib': ZlibCodec, 'zstd': ZstdCodec}
+
+def make_codec(name: str, dictionaries: Optional[Mapping[str, bytes]] = None):
+    """Codec called name, where 'zstd:<id>' uses the zstd dictionary with that id"""
+    kind, _, dictionary_id = name.partition(':')
+    if dictionary_id:
+        return CODECS[kind](dictionaries[dictionary_id], dictionary_id)
+    return CODECS[kind]()
+
+# zlib data never starts with a null byte, so older untagged rows can't be confused with tagged rows
+_CODEC_TAG = b'\x00'
+
+def encode_payload(codec, content: Optional[bytes]):
+    if content is None:
+        return None
+    return sqlite3.Binary(_CODEC_TAG + codec.name.encode('ascii') + _CODEC_TAG + codec.compress(content))
+
+def decode_payload(get_codec: Callable, row) -> Optional[bytes]:
+    """Decode a row of the fetch cache, where get_codec returns the codec for a name"""
+    if row is None:
+        return None
+    row = bytes(row)
+    if not row.startswith(_CODEC_TAG):
+        return zlib.decompress(row)
+    name, _, data = row[1:].partition(_CODEC_TAG)
+    return get_codec(name.decode('ascii')).decompress(data)
+
+# Cell
+from collections.abc import MutableMapping
+import itertools
+import zlib
+from sqlitedict import SqliteDict
+
+class ShardedSqliteDict(MutableMapping):
+    def __init__(self, paths, **kwargs):
+        self.shards = [SqliteDict(path, **kwargs) for path in paths]
+
+    def shard(self, key: str) -> SqliteDict:
+        return self.shards[zlib.crc32(key.encode('utf-8')) % len(self.shards)]
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self.shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self.shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self.shard(key)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(shard.keys() for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def items(self):
+        return itertools.chain.from_iterable(shard.items() for shard in self.shards)
+
+    def commit(self):
+        # Start all the commits before waiting for any of them
+        for shard in self.shards:
+            shard.commit(blocking=False)
+        for shard in self.shards:
+            shard.commit()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+# Cell
+import mmap
+import os
+from pathlib import Path
+try:
+    import fcntl
+except ImportError:
+    # Windows, where a blob store can only have one writer
+    fcntl = None
+
+class BlobStore(MutableMapping):
+    def __init__(self, path: Union[str, Path], index: SqliteDict):
+        self.path = Path(path)
+        self.index = index
+        self._file = open(self.path, 'ab')
+        self._pending = {}
+        self._view = memoryview(b'')
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            return self._pending[key]
+        location = self.index[key]
+        if location is None:
+            return None
+        offset, length = location
+        if offset + length > len(self._view):
+            self._remap()
+        return self._view[offset:offset + length]
+
+    def _remap(self):
+        # Views of the old map keep it open for as long as they're used
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def __setitem__(self, key, content: Optional[bytes]):
+        self._pending[key] = content
+
+    def __delitem__(self, key):
+        if self._pending.pop(key, False) is False or key in self.index:
+            del self.index[key]
+
+    def __contains__(self, key):
+        return key in self._pending or key in self.index
+
+    def __iter__(self):
+        yield from self.index.keys()
+        yield from (key for key in list(self._pending) if key not in self.index)
+
+    def __len__(self):
+        return len(self.index) + sum(key not in self.index for key in self._pending)
+
+    def commit(self):
+        """Append the pending content to the file, and then add it to the index"""
+        locations = {}
+        if fcntl is not None:
+            # Other processes may be appending too, so only take offsets while no one else can write
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._file.seek(0, os.SEEK_END)
+            offset = os.fstat(self._file.fileno()).st_size
+            for key, content in self._pending.items():
+                if content is None:
+                    locations[key] = None
+                    continue
+                locations[key] = (offset, len(content))
+                self._file.write(content)
+                offset += len(content)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+        for key, location in locations.items():
+            self.index[key] = location
+        self.index.commit()
+        self._pending.clear()
+
+    def close(self):
+        self._file.close()
+        self._view.release()
+        if hasattr(self, '_map'):
+            try:
+                self._map.close()
+            except BufferError:
+                # Views that are still in use keep the map open until they're released
+                pass
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 # Cell
 import itertools
+import os
+import socket
 from pathlib import Path
 from sqlitedict import SqliteDict
 
@@ -75,73 +418,460 @@ def minibatch(seq, size):
     if items:
         yield items
 
+import math
 import zlib, pickle, sqlite3
 def compress_encode(obj: bytes):
      return sqlite3.Binary(zlib.compress(obj))
 def compress_decode(obj):
      return zlib.decompress(bytes(obj))
 
+def _pickle_compress_encode(obj):
+    return compress_encode(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+def _pickle_compress_decode(obj):
+    return pickle.loads(compress_decode(obj))
+
+def dedup_by_digest(records):
+    """The cheapest record to fetch for each digest, by the fetch_cost of its type"""
+    cheapest = {}
+    for record in records:
+        assert record.digest is not None
+        current = cheapest.get(record.digest)
+        if current is None or getattr(record, 'fetch_cost', math.inf) < getattr(current, 'fetch_cost', math.inf):
+            cheapest[record.digest] = record
+    return list(cheapest.values())
+
 class RunnerCached():
-    def __init__(self, process: Process, path: Union[str, Path], progress_bar: bool = True, batch_size: int = 1024):
+    def __init__(self, process: Process, path: Union[str, Path], progress_bar: bool = True, batch_size: int = 1024,
+                 concurrency: Optional[int] = None, stream: bool = False,
+                 workers: Optional[int] = None, ordered: bool = True, cache_steps: bool = False,
+                 codec: str = 'zlib', shards: Optional[Union[int, Sequence[Union[str, Path]]]] = None,
+                 blob_store: bool = False, metrics: Optional[Metrics] = None, profiler: Optional[StepProfiler] = None):
         self.process = process
         self.progress_bar = progress_bar
         self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.stream = stream
+        self.workers = workers
+        self.ordered = ordered
+        self.cache_steps = cache_steps
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler
 
         self.path = Path(path)
 
+        # Queries cached as a single list by older versions
         self._query = SqliteDict(path, tablename='query', autocommit=True)
-        self._fetch = SqliteDict(path, tablename='fetch', autocommit=False, encode=compress_encode, decode=compress_decode)
+        self._query_pages = SqliteDict(path, tablename='query_pages', autocommit=True,
+                                       encode=_pickle_compress_encode, decode=_pickle_compress_decode)
+        self._query_progress = SqliteDict(path, tablename='query_progress', autocommit=True)
+        self._dictionaries = SqliteDict(path, tablename='dictionaries', autocommit=True)
+        self._codecs = {}
+        self.codec = self._codec(codec)
+        if codec == 'zstd' and len(self._dictionaries) > 0:
+            # Use the most recently trained dictionary
+            self.codec = self._codec(f'zstd:{list(self._dictionaries.keys())[-1]}')
+        fetch_kwargs = dict(tablename='fetch', autocommit=False,
+                            encode=lambda content: encode_payload(self.codec, content),
+                            decode=lambda row: decode_payload(self._codec, row))
+        if blob_store:
+            if shards is not None:
+                raise ValueError("A blob store can't be sharded")
+            self._fetch = BlobStore(self.path.with_name(f'{self.path.stem}.blobs'),
+                                    SqliteDict(path, tablename='blobs', autocommit=False))
+        elif shards is None:
+            self._fetch = SqliteDict(path, **fetch_kwargs)
+        else:
+            shard_paths = self._shard_paths(shards)
+            self._fetch = ShardedSqliteDict(shard_paths, **fetch_kwargs)
+        self._steps = SqliteDict(path, tablename='steps', autocommit=False)
+
+    def _shard_paths(self, shards):
+        if isinstance(shards, int):
+            shards = [self.path.with_name(f'{self.path.stem}.shard{i}{self.path.suffix}') for i in range(shards)]
+        # Content is found by the number of shards, so it can't change
+        shard_info = SqliteDict(self.path, tablename='shards', autocommit=True)
+        num_shards = shard_info.setdefault('count', len(shards))
+        shard_info.close()
+        if num_shards != len(shards):
+            raise ValueError(f'Cache {self.path} has {num_shards} shards, but got {len(shards)}')
+        return shards
+
+    def _codec(self, name):
+        if name not in self._codecs:
+            self._codecs[name] = make_codec(name, self._dictionaries)
+        return self._codecs[name]
+
+    def train_dictionary(self, max_samples: int = 1024, dict_size: int = ZSTD_DICT_SIZE, recompress: bool = True) -> str:
+        """Train a zstd dictionary on cached content, and use it to compress content from now on
+
+        With recompress the content already in the cache is compressed again with the dictionary."""
+        if isinstance(self._fetch, BlobStore):
+            raise ValueError("Content in a blob store isn't compressed")
+        import zstandard
+        samples = [content for _, content in itertools.islice(self._fetch.items(), max_samples) if content]
+        dictionary = zstandard.train_dictionary(dict_size, samples)
+        dictionary_id = str(dictionary.dict_id())
+        self._dictionaries[dictionary_id] = dictionary.as_bytes()
+        self.codec = self._codec(f'zstd:{dictionary_id}')
+
+        if recompress:
+            for keys in minibatch(list(self._fetch.keys()), self.batch_size):
+                for key in keys:
+                    self._fetch[key] = self._fetch[key]
+                self._fetch.commit()
+        return dictionary_id
 
     def query(self):
         # TODO: Don't cache WaybackQuery or FileQuery
-        for query in tqdm(self.process.queries, desc='query', disable=not self.progress_bar):
-            key = repr(query)
-            if key not in self._query:
-                self._query[key] = list(query.query())
+        queries = tqdm(self.process.queries, desc='query', disable=not self.progress_bar)
+        return self.metrics.timed((record for query in queries for record in self.query_cached(query)), 'query')
+
+    def query_cached(self, query):
+        """Yield the records of query, storing each page as it arrives so an interrupted query can resume"""
+        key = repr(query)
+        if key in self._query:
+            yield from self._query[key]
+            return
 
-        # TODO: Merge
-        for query in self.process.queries:
-            for record in self._query[key]:
-                yield record
+        num_pages, complete = self._query_progress.get(key, (0, False))
+        resumable = hasattr(query, 'query_pages')
+        if not complete and not resumable:
+            num_pages = 0
+
+        done = set()
+        for n in range(num_pages):
+            page_key, table = self._query_pages[f'{key}\t{n}']
+            done.add(page_key)
+            yield from table_to_records(table)
+        if complete:
+            return
+
+        if resumable:
+            pages = query.query_pages(skip=done)
+        else:
+            pages = enumerate(minibatch(query.query(), self.batch_size))
+        for page_key, records in pages:
+            self._query_pages[f'{key}\t{num_pages}'] = (page_key, records_to_table(records))
+            num_pages += 1
+            self._query_progress[key] = (num_pages, False)
+            yield from records
+        self._query_progress[key] = (num_pages, True)
 
     def prepare(self, records):
-        return self.process.filter(tqdm(records, desc='filter', disable=not self.progress_bar))
+        return self.metrics.timed(self.process.filter(tqdm(records, desc='filter', disable=not self.progress_bar)), 'filter')
+
+    def _commit(self, table):
+        with self.metrics.timer('cache_commit_seconds', table=table):
+            getattr(self, f'_{table}').commit()
+
+    def _cached_content(self, digest):
+        with self.metrics.timer('cache_read_seconds'):
+            return self._fetch[digest]
+
+    def _store_fetched(self, content_records):
+        """Store and yield the fetched content_records, counting their size"""
+        for content, record in content_records:
+            assert record.digest is not None
+            self._fetch[record.digest] = content
+            if content is not None:
+                self.metrics.count('fetch_bytes', len(content))
+            yield content, record
+
+    def fetch_parallel(self, records, callback=None):
+        if self.concurrency:
+            # Only import aiohttp when it's needed
+            from .aio import aio_fetch_parallel
+            yield from aio_fetch_parallel(records, concurrency=self.concurrency, callback=callback)
+            return
+
+        records = sorted(records, key=lambda x: str(type(x)))
+        for cls, record_group in itertools.groupby(records, key=type):
+            for record_group_batch in minibatch(record_group, self.batch_size):
+                yield from zip(cls.fetch_parallel(record_group_batch, callback=callback), record_group_batch)
+
+    def fetch_stream(self, records):
+        """Fetch and yield one minibatch at a time, so memory depends on batch_size and not the number of records"""
+        with tqdm(desc='fetch', disable=not self.progress_bar) as pbar:
+            for batch in minibatch(records, self.batch_size):
+                unfetched_records = dedup_by_digest(r for r in batch if r.digest not in self._fetch)
+                self.metrics.count('cache_hits', len(batch) - len(unfetched_records))
+                self.metrics.count('cache_misses', len(unfetched_records))
+                self.metrics.gauge('fetch_pending', len(unfetched_records))
+
+                fetched = {}
+                for content, record in self._store_fetched(self.fetch_parallel(unfetched_records)):
+                    fetched[record.digest] = content
+                self._commit('fetch')
+                self.metrics.gauge('fetch_pending', 0)
+                if isinstance(self._fetch, BlobStore):
+                    # Read fresh content back from the store so steps always get views of it
+                    fetched.clear()
+
+                for record in batch:
+                    content = fetched[record.digest] if record.digest in fetched else self._cached_content(record.digest)
+                    yield (content, record)
+                pbar.update(len(batch))
+
+    def fetch_queue(self) -> LeaseQueue:
+        return LeaseQueue(self.path.with_name(f'{self.path.stem}.queue{self.path.suffix}'))
+
+    def enqueue_fetch(self, records=None, lease_size: Optional[int] = None) -> int:
+        """Put the records that aren't cached or queued on the fetch queue in batches, returning the number of batches"""
+        if records is None:
+            records = self.prepare(self.query())
+        queue = self.fetch_queue()
+        # Batches left from an earlier run are still fetched, so don't queue them again
+        skip = set(self._fetch.keys()) | queue.queued_digests()
+        unfetched_records = dedup_by_digest(r for r in records if r.digest not in skip)
+
+        num_leases = 0
+        for batch in minibatch(unfetched_records, lease_size or self.batch_size):
+            queue.put(batch)
+            num_leases += 1
+        queue.close()
+        return num_leases
+
+    def fetch_worker(self, owner: Optional[str] = None, lease_seconds: float = 600., poll_seconds: float = 1.) -> int:
+        """Fetch batches from the fetch queue into the cache until all are done, returning the number fetched"""
+        if isinstance(self._fetch, BlobStore) and fcntl is None:
+            raise ValueError("Several processes can't write a blob store without fcntl")
+        owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        queue = self.fetch_queue()
+        num_leases = 0
+        try:
+            while True:
+                lease = queue.claim(owner, lease_seconds)
+                if lease is None:
+                    # Other workers hold the rest; wait in case one of them dies
+                    if queue.pending() == 0:
+                        return num_leases
+                    time.sleep(poll_seconds)
+                    continue
+                lease_id, records = lease
+                # Fetch before writing so we don't hold the cache's write lock while waiting on the network
+                content_records = list(self.fetch_parallel(records))
+                for _ in self._store_fetched(content_records):
+                    pass
+                self._commit('fetch')
+                queue.complete(lease_id)
+                num_leases += 1
+                self.metrics.gauge('fetch_queue_pending', queue.pending())
+        finally:
+            queue.close()
 
     def fetch(self, records):
+        content_records = self.fetch_stream(records) if self.stream else self._fetch_all(records)
+        return self.metrics.timed(content_records, 'fetch')
+
+    def _fetch_all(self, records):
         records = list(records)
         fetched = set(self._fetch.keys())
-        unfetched_records = [r for r in records if r.digest not in fetched]
-        unfetched_records = sorted(unfetched_records, key=lambda x: str(type(x)))
-
-        with tqdm(total=len(unfetched_records), desc='fetch') as pbar:
-            for cls, record_group in itertools.groupby(unfetched_records, key=type):
-                for record_group_batch in minibatch(record_group, self.batch_size):
-                    record_group_batch = list(record_group_batch)
-                    for content, record in zip(cls.fetch_parallel(record_group_batch,
-                                                                  callback=lambda r, c: pbar.update(1)),
-                                               record_group_batch):
-                        assert record.digest is not None
-                        self._fetch[record.digest] = content
-                    self._fetch.commit()
+        unfetched_records = dedup_by_digest(r for r in records if r.digest not in fetched)
+        self.metrics.count('cache_hits', len(records) - len(unfetched_records))
+        self.metrics.count('cache_misses', len(unfetched_records))
+
+        with tqdm(total=len(unfetched_records), desc='fetch', disable=not self.progress_bar) as pbar:
+            content_records = self.fetch_parallel(unfetched_records, callback=lambda r, c: pbar.update(1))
+            for n, batch in enumerate(minibatch(self._store_fetched(content_records), self.batch_size)):
+                self._commit('fetch')
+                self.metrics.gauge('fetch_pending', max(0, len(unfetched_records) - (n + 1) * self.batch_size))
 
         for record in records:
-            yield (self._fetch[record.digest], record)
+            yield (self._cached_content(record.digest), record)
 
 
     def transform(self, content_records):
-        for content, record in tqdm(content_records, desc='transform', disable=not self.progress_bar):
-            error = False
-            for step in self.process.steps:
-                try:
-                    content = step(content, record)
-                except Exception as e:
-                    error = True
-                    logging.error('Error processing %s at step %s: %s' % (record, step.__name__, e))
-                    break
-            if not error:
-                yield content
+        content_records = tqdm(content_records, desc='transform', disable=not self.progress_bar)
+        if self.workers:
+            # Views of the blob store can't be sent to other processes
+            content_records = ((bytes(content) if isinstance(content, memoryview) else content, record)
+                               for content, record in content_records)
+        if not self.cache_steps:
+            results = transform_parallel(content_records, self.process.steps, self.workers, ordered=self.ordered,
+                                         metrics=self.metrics, profiler=self.profiler)
+        else:
+            results = self.transform_cached(content_records)
+        return self.metrics.timed(results, 'transform')
+
+    def _skip_cached_steps(self, versions, content, record):
+        keys = step_keys(versions, record)
+        for i in reversed(range(len(keys))):
+            if keys[i] is not None and keys[i] in self._steps:
+                return keys[i+1:], self.process.steps[i+1:], self._steps[keys[i]], record
+        return keys, self.process.steps, content, record
+
+    def transform_cached(self, content_records):
+        """Transform, reusing the output of steps stored by previous runs and storing the new ones"""
+        versions = [step_version(step) for step in self.process.steps]
+        memory = self.profiler is not None and self.profiler.memory
+        args = ((*self._skip_cached_steps(versions, content, record), memory, self.profiler is not None and self.profiler.sample())
+                for content, record in content_records)
+        try:
+            results = _map(_run_remaining_steps, args, self.workers, self.ordered)
+            for n, (ok, content, record, outputs, timings, stats) in enumerate(results, 1):
+                for key, output in outputs:
+                    # Views of the blob store can't be pickled
+                    self._steps[key] = bytes(output) if isinstance(output, memoryview) else output
+                _record_timings(record, timings, stats, self.metrics, self.profiler)
+                if n % self.batch_size == 0:
+                    self._commit('steps')
+                if ok:
+                    yield content
+        finally:
+            self._commit('steps')
 
     def run(self):
         records = self.prepare(self.query())
         content_records = self.fetch(records)
-        return self.transform(content_records)
\ No newline at end of file
+        return self.transform(content_records)
+
+    def close(self):
+        for table in (self._query, self._query_pages, self._query_progress, self._dictionaries, self._fetch, self._steps):
+            table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Cell
+import dataclasses
+import itertools
+from .query import _reduce_record
+
+def records_to_table(records):
+    """Store dataclass records as a list of (class, field names, rows)"""
+    table = []
+    for cls, group in itertools.groupby(records, key=type):
+        names = tuple(field.name for field in dataclasses.fields(cls))
+        # Compact records keep their fields in slots in the same order, encoded in a form __init__ accepts
+        attributes = cls.__slots__ if cls.__reduce__ is _reduce_record else names
+        table.append((cls, names, [tuple(getattr(record, attribute) for attribute in attributes) for record in group]))
+    return table
+
+def table_to_records(table):
+    for cls, names, rows in table:
+        for row in rows:
+            yield cls(**dict(zip(names, row)))
+
+# Cell
+import inspect
+from functools import lru_cache
+from .util import sha1_digest
+
+def step_version(step: Callable) -> Optional[str]:
+    """Identify step by its version attribute, source or pickle, or None if it has none of them
+
+    Only the step's own source is used, not the functions it calls, its closure or its defaults."""
+    name = getattr(step, '__qualname__', type(step).__qualname__)
+    version = getattr(step, 'version', None)
+    if version is None:
+        try:
+            version = sha1_digest(inspect.getsource(step).encode('utf-8'))
+        except (OSError, TypeError):
+            try:
+                version = sha1_digest(pickle.dumps(step))
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                logging.warning(f"Not caching step {name} or the steps after it, since it has no version: {e}")
+                return None
+    return f'{step.__module__}.{name}:{version}'
+
+def step_keys(versions: list[Optional[str]], record) -> list[Optional[str]]:
+    """Cache key for the output of each step on record, which is None from the first step without a version"""
+    keys = []
+    identity = repr(record)
+    for version in versions:
+        if version is None:
+            return keys + [None] * (len(versions) - len(keys))
+        identity += '\n' + version
+        keys.append(sha1_digest(identity.encode('utf-8')))
+    return keys
+
+@lru_cache(maxsize=None)
+def _warn_unpicklable_output(name: str, error: str):
+    logging.warning(f"Not caching step {name} or the steps after it, since its output can't be pickled: {error}")
+
+def _picklable_output(step, content) -> bool:
+    # Views are stored as bytes, which always pickle
+    if isinstance(content, (bytes, memoryview)):
+        return True
+    try:
+        pickle.dumps(content)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        _warn_unpicklable_output(getattr(step, '__qualname__', type(step).__qualname__), str(e))
+        return False
+    return True
+
+def _run_remaining_steps(keys, steps, content, record, memory=False, profile=False):
+    """Run steps on content, returning the outputs to cache up to the first without a key or that can't be pickled"""
+    outputs, timings = [], []
+    ok, caching = True, True
+    with _StepProfile(memory, profile) as step_profile:
+        for key, step in zip(keys, steps):
+            ok, content = _run_steps([step], content, record, timings, memory)
+            if not ok:
+                break
+            caching = caching and key is not None and _picklable_output(step, content)
+            if caching:
+                outputs.append((key, content))
+    return ok, content, record, outputs, timings, step_profile.stats
+
+# Cell
+import sqlite3
+import time
+from pathlib import Path
+
+class LeaseQueue:
+    def __init__(self, path, timeout: float = 60.):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(path), timeout=timeout, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS leases '
+                          '(id INTEGER PRIMARY KEY, records BLOB NOT NULL, owner TEXT, expires REAL, done INTEGER NOT NULL DEFAULT 0)')
+
+    def put(self, records: list) -> int:
+        cursor = self.conn.execute('INSERT INTO leases (records) VALUES (?)', (_pickle_compress_encode(records),))
+        return cursor.lastrowid
+
+    def claim(self, owner: str, lease_seconds: float):
+        """Lease the first batch that isn't done and has no unexpired lease to owner for lease_seconds
+
+        Returns (lease_id, records), or None when every batch is done or leased."""
+        now = time.time()
+        # Take the write lock before reading so two workers can't claim the same lease
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute('SELECT id, records FROM leases WHERE done = 0 AND (expires IS NULL OR expires <= ?) '
+                                    'ORDER BY id LIMIT 1', (now,)).fetchone()
+            if row is not None:
+                self.conn.execute('UPDATE leases SET owner = ?, expires = ? WHERE id = ?', (owner, now + lease_seconds, row[0]))
+        finally:
+            self.conn.execute('COMMIT')
+        if row is None:
+            return None
+        return row[0], _pickle_compress_decode(row[1])
+
+    def complete(self, lease_id: int):
+        self.conn.execute('UPDATE leases SET done = 1 WHERE id = ?', (lease_id,))
+
+    def queued_digests(self) -> set[str]:
+        """Digests of the records in batches that aren't done, including those leased"""
+        rows = self.conn.execute('SELECT records FROM leases WHERE done = 0')
+        return {record.digest for row in rows for record in _pickle_compress_decode(row[0])}
+
+    def pending(self) -> int:
+        """Number of batches that aren't done, including those leased"""
+        return self.conn.execute('SELECT COUNT(*) FROM leases WHERE done = 0').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+# Cell
+def _fetch_worker(process, path, kwargs):
+    return RunnerCached(process, path, progress_bar=False, **kwargs).fetch_worker()
+
+def run_fetch_workers(process, path, workers: int, **kwargs) -> list[int]:
+    """Run workers fetch_worker processes on the queue of the cache at path, returning the number of batches each fetched"""
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_fetch_worker, process, path, kwargs) for _ in range(workers)]
+        return [future.result() for future in futures]
\ No newline at end of file
@@ -0,0 +1,324 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/04_testserver.ipynb (unless otherwise specified).
+
+
+from __future__ import annotations
+
+
+__all__ = ['WarcRangeServer', 'warc_to_cc_records', 'cc_data_url', 'ArchiveServer', 'standin_urls']
+
+# Cell
+#nbdev_comment from __future__ import annotations
+import json
+import math
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional, Union
+from urllib.parse import parse_qs, unquote, urlparse
+
+import warcio
+
+import webrefine.query
+from .query import CommonCrawlRecord, _decode_cc_warc, get_warc_url, get_warc_timestamp, get_warc_mime, get_warc_status, get_warc_digest
+
+# Cell
+class _RangeRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like a real server
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self._admit():
+            self._send_file(unquote(urlparse(self.path).path).lstrip('/'))
+
+    def _admit(self) -> bool:
+        """Count the request and wait for the latency, returning False if it was throttled"""
+        count = self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.throttle_every and count % self.server.throttle_every == 0:
+            headers = {} if self.server.retry_after is None else {'Retry-After': str(self.server.retry_after)}
+            self._send(429, b'', headers=headers)
+            return False
+        return True
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/octet-stream', headers: dict = {}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count_bytes(len(body))
+
+    def _send_file(self, name: str):
+        data = self.server.read(name)
+        if data is None:
+            self.send_error(404)
+            return
+
+        byte_range = self.headers.get('Range')
+        if not byte_range:
+            self._send(200, data)
+            return
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', byte_range)
+        if not match:
+            self.send_error(416)
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+        self._send(206, data[start:end+1], headers={'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StandinHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Allow many concurrent clients to connect at once
+    request_queue_size = 1024
+
+    def __init__(self, address, handler, root: Path, latency: float,
+                 throttle_every: int = 0, retry_after: Optional[int] = None):
+        super().__init__(address, handler)
+        self.root = root.resolve()
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def count_request(self) -> int:
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+    def count_bytes(self, size: int):
+        with self._lock:
+            self.bytes_sent += size
+
+    def read(self, name: str):
+        path = (self.root / name).resolve()
+        if self.root not in path.parents or not path.is_file():
+            return None
+        if path not in self._files:
+            self._files[path] = path.read_bytes()
+        return self._files[path]
+
+
+class WarcRangeServer:
+    """Serve the files under root over HTTP with Range support, standing in for data.commoncrawl.org.
+
+    Each request sleeps for latency seconds before responding.
+    With throttle_every set every throttle_every-th request gets a 429, with a Retry-After of retry_after seconds if set.
+    Use as a context manager; `url` is the base URL, `requests` counts requests served and `bytes_sent` the bytes in their bodies."""
+    handler = _RangeRequestHandler
+
+    def __init__(self, root: Union[str, Path], latency: float = 0.0, host: str = '127.0.0.1', port: int = 0,
+                 throttle_every: int = 0, retry_after: Optional[int] = None):
+        self.root = Path(root)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self) -> WarcRangeServer:
+        self._server = _StandinHTTPServer((self.host, self.port), self.handler, self.root, self.latency,
+                                          self.throttle_every, self.retry_after)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}/'
+
+    @property
+    def requests(self) -> int:
+        return self._server.requests
+
+    @property
+    def bytes_sent(self) -> int:
+        return self._server.bytes_sent
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+# Cell
+def warc_to_cc_records(path: Union[str, Path]) -> list[CommonCrawlRecord]:
+    """CommonCrawlRecords for the responses in the WARC at path, with filename relative to its directory"""
+    path = Path(path)
+    records = []
+    with open(path, 'rb') as f:
+        archive = warcio.ArchiveIterator(f)
+        for record in archive:
+            if record.rec_type != 'response':
+                continue
+            url = get_warc_url(record)
+            timestamp = get_warc_timestamp(record)
+            mime = get_warc_mime(record)
+            status = get_warc_status(record)
+            digest = get_warc_digest(record)
+            # Need to read the record to know its length
+            archive.read_to_end(record)
+            records.append(CommonCrawlRecord(url=url, timestamp=timestamp,
+                                             filename=path.name,
+                                             offset=archive.get_record_offset(),
+                                             length=archive.get_record_length(),
+                                             mime=mime, status=status, digest=digest))
+    return records
+
+@contextmanager
+def cc_data_url(url: str):
+    """Temporarily fetch Common Crawl data from url instead of CC_DATA_URL"""
+    original = webrefine.query.CC_DATA_URL
+    webrefine.query.CC_DATA_URL = url
+    try:
+        yield
+    finally:
+        webrefine.query.CC_DATA_URL = original
+
+# Cell
+def _url_key(url: str) -> str:
+    return re.sub(r'^(https?://)?(www\.)?', '', url)
+
+def _url_matches(pattern: str, url: str) -> bool:
+    pattern, url = _url_key(pattern), _url_key(url)
+    if pattern.endswith('*'):
+        return url.startswith(pattern[:-1])
+    return url.rstrip('/') == pattern.rstrip('/')
+
+class _ArchiveIndex:
+    def __init__(self, root: Path, crawl: str, block_size: int, copies: int):
+        self.crawl = crawl
+        self.block_size = block_size
+        self.captures = []
+        self.payloads = {}
+        for path in sorted(root.glob('**/*.warc.gz')):
+            filename = str(path.relative_to(root))
+            data = path.read_bytes()
+            for record in warc_to_cc_records(path):
+                payload = _decode_cc_warc(data[record.offset:record.offset + record.length])
+                for copy in range(copies):
+                    timestamp = record.timestamp.timestamp() + copy
+                    capture = dict(url=record.url, timestamp=time.strftime('%Y%m%d%H%M%S', time.gmtime(timestamp)),
+                                   mime=record.mime, status=str(record.status), digest=record.digest,
+                                   length=str(record.length), offset=str(record.offset), filename=filename)
+                    self.captures.append(capture)
+                    self.payloads[(capture['timestamp'], _url_key(record.url))] = payload
+        self.captures.sort(key=lambda c: (_url_key(c['url']), c['timestamp']))
+
+    def matching(self, url: str) -> list[dict]:
+        return [c for c in self.captures if _url_matches(url, c['url'])]
+
+    def collinfo(self, base_url: str) -> list[dict]:
+        return [{'id': self.crawl, 'name': self.crawl,
+                 'timegate': f'{base_url}{self.crawl}/', 'cdx-api': f'{base_url}{self.crawl}-index'}]
+
+    def cc_cdx(self, params: dict) -> bytes:
+        captures = self.matching(params['url'][0])
+        page_size = int(params.get('pageSize', ['5'])[0])
+        if params.get('showNumPages', [''])[0].lower() == 'true':
+            blocks = math.ceil(len(captures) / self.block_size)
+            return json.dumps({'pages': math.ceil(blocks / page_size), 'pageSize': page_size, 'blocks': blocks}).encode()
+
+        # Like Common Crawl, filters apply to the captures in the page
+        captures_per_page = page_size * self.block_size
+        page = int(params.get('page', ['0'])[0])
+        captures = captures[page * captures_per_page:(page + 1) * captures_per_page]
+        for f in params.get('filter', []):
+            if f.startswith('='):
+                field, value = f[1:].split(':', 1)
+                captures = [c for c in captures if c.get(field) == value]
+            elif f.startswith('~'):
+                field, value = f[1:].split(':', 1)
+                captures = [c for c in captures if re.search(value, c.get(field) or '')]
+        return ''.join(json.dumps(c) + '\n' for c in captures).encode()
+
+    def ia_cdx(self, params: dict) -> bytes:
+        captures = self.matching(params['url'][0])
+        start, end = params.get('from', [''])[0], params.get('to', [''])[0]
+        captures = [c for c in captures if c['timestamp'][:len(start)] >= start and (not end or c['timestamp'][:len(end)] <= end)]
+        fields = {'statuscode': 'status', 'mimetype': 'mime'}
+        for f in params.get('filter', []):
+            field, value = f.split(':', 1)
+            captures = [c for c in captures if re.fullmatch(value, c[fields[field]] or '')]
+        offset = int(params.get('offset', ['0'])[0])
+        limit = int(params.get('limit', [str(len(captures))])[0])
+        rows = [['urlkey', 'timestamp', 'original', 'mimetype', 'statuscode', 'digest', 'length']]
+        rows += [[_url_key(c['url']), c['timestamp'], c['url'], c['mime'], c['status'], c['digest'], c['length']]
+                 for c in captures[offset:offset + limit]]
+        return json.dumps(rows).encode()
+
+
+class _ArchiveRequestHandler(_RangeRequestHandler):
+    def do_GET(self):
+        if not self._admit():
+            return
+        url = urlparse(self.path)
+        path, params = unquote(url.path), parse_qs(url.query)
+        index = self.server.archive
+        base_url = 'http://%s:%d/' % self.server.server_address[:2]
+        if path == '/collinfo.json':
+            self._send(200, json.dumps(index.collinfo(base_url)).encode(), 'application/json')
+        elif path == f'/{index.crawl}-index':
+            self._send(200, index.cc_cdx(params), 'text/x-ndjson')
+        elif path == '/cdx/search/cdx':
+            self._send(200, index.ia_cdx(params), 'application/json')
+        elif path.startswith('/web/'):
+            # Everything after the timestamp is the original URL, including its query string
+            match = re.match(r'/web/(\d+)id_/(.*)', self.path)
+            payload = match and index.payloads.get((match.group(1), _url_key(match.group(2))))
+            if payload is None:
+                self.send_error(404)
+            else:
+                self._send(200, payload, 'text/html')
+        else:
+            self._send_file(path.lstrip('/'))
+
+
+class ArchiveServer(WarcRangeServer):
+    """Stand in for data.commoncrawl.org, the Common Crawl index and the Internet Archive, from the WARC files under root"""
+    handler = _ArchiveRequestHandler
+
+    def __init__(self, root: Union[str, Path], crawl: str = 'CC-MAIN-2021-43', block_size: int = 5, copies: int = 1, **kwargs):
+        super().__init__(root, **kwargs)
+        self.archive = _ArchiveIndex(self.root.resolve(), crawl, block_size, copies)
+
+    def start(self) -> ArchiveServer:
+        super().start()
+        self._server.archive = self.archive
+        return self
+
+
+@contextmanager
+def standin_urls(url: str):
+    """Temporarily send all requests to the archives to url instead, without the Common Crawl disk cache"""
+    q = webrefine.query
+    originals = q.CC_DATA_URL, q.CC_INDEX_URL, q.IA_CDX_URL, q.IA_WAYBACK_URL, q.CC_CACHE_PATH
+    q.CC_DATA_URL, q.CC_INDEX_URL, q.IA_CDX_URL, q.IA_WAYBACK_URL = url, url, url + 'cdx/search/cdx', url + 'web/'
+    q.CC_CACHE_PATH = None
+    q.get_cc_indexes.cache_clear()
+    try:
+        yield
+    finally:
+        q.CC_DATA_URL, q.CC_INDEX_URL, q.IA_CDX_URL, q.IA_WAYBACK_URL, q.CC_CACHE_PATH = originals
+        q.get_cc_indexes.cache_clear()
\ No newline at end of file
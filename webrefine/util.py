@@ -1,8 +1,14 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_util.ipynb (unless otherwise specified).
 
-__all__ = ['sha1_digest', 'URL', 'make_session']
+
+from __future__ import annotations
+
+
+__all__ = ['sha1_digest', 'URL', 'make_session', 'parse_retry_after', 'AdaptiveController', 'default_controller',
+           'THROTTLE_STATUS', 'TTLCache']
 
 # Cell
+#nbdev_comment from __future__ import annotations
 from hashlib import sha1
 from base64 import b32encode
 
@@ -27,14 +33,281 @@ class URL:
         return self.url
 
 # Cell
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+def make_session(pool_maxsize, controller=None):
+    # requests is only imported once it's needed, so workers that don't make requests start quickly
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
 
-def make_session(pool_maxsize):
-    retry_strategy =  Retry(total=5, backoff_factor=1, status_forcelist=set([504, 500]))
-    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_maxsize, pool_block=True)
+    # The controller handles Retry-After for all requests to the host
+    retry_strategy =  Retry(total=5, backoff_factor=1, status_forcelist=set([504, 500]),
+                            respect_retry_after_header=controller is None)
+    if controller is None:
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_maxsize, pool_block=True)
+    else:
+        adapter = _adaptive_adapter_class()(controller, max_retries=retry_strategy, pool_maxsize=pool_maxsize, pool_block=True)
     session = requests.Session()
     session.mount('http://', adapter)
     session.mount('https://', adapter)
-    return session
\ No newline at end of file
+    return session
+
+# Cell
+import email.utils
+import logging
+import math
+import threading
+import time
+from typing import Callable, Mapping, Optional
+from urllib.parse import urlsplit
+
+# Statuses that mean the server wants us to slow down
+THROTTLE_STATUS = {429, 503}
+
+def parse_retry_after(value: str, now: Optional[float] = None) -> float:
+    """Seconds to wait from a Retry-After header, which is either seconds or a HTTP date"""
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.
+    return max(0., date.timestamp() - (time.time() if now is None else now))
+
+
+class _HostState:
+    def __init__(self, limit: float, rate: Optional[float], burst: float, now: float):
+        self.limit = limit
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.in_flight = 0
+        self.blocked_until = now
+        self.last_decrease = -math.inf
+        self.latency = None
+        self.min_latency = None
+        self.error_rate = 0.
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.increases = 0
+        self.decreases = 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class AdaptiveController:
+    def __init__(self, rate: Optional[float] = None, rates: Optional[Mapping[str, float]] = None,
+                 max_concurrency: int = 128, min_concurrency: int = 1, initial_concurrency: Optional[int] = None,
+                 increase: float = 1., decrease: float = 0.5, max_error_rate: float = 0.25,
+                 latency_factor: Optional[float] = None, throttle_backoff: float = 1., smoothing: float = 0.2,
+                 poll_seconds: float = 0.01, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.rates = dict(rates or {})
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = initial_concurrency or max_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+        self.throttle_backoff = throttle_backoff
+        self.smoothing = smoothing
+        self.poll_seconds = poll_seconds
+        self.clock = clock
+        self._hosts = {}
+        self._released = threading.Condition(threading.Lock())
+
+    def _host(self, host: str) -> _HostState:
+        if host not in self._hosts:
+            rate = self.rates.get(host, self.rate)
+            self._hosts[host] = _HostState(self.initial_concurrency, rate, max(1., rate or 1.), self.clock())
+        return self._hosts[host]
+
+    def _try_acquire(self, host: str) -> float:
+        state = self._host(host)
+        now = self.clock()
+        if now < state.blocked_until:
+            return state.blocked_until - now
+        if state.in_flight >= int(state.limit):
+            return math.inf
+        if state.rate is not None:
+            state.refill(now)
+            if state.tokens < 1:
+                return (1 - state.tokens) / state.rate
+            state.tokens -= 1
+        state.in_flight += 1
+        state.requests += 1
+        return 0.
+
+    def try_acquire(self, host: str) -> float:
+        """Start a request to host and return 0, or else how long to wait before trying again (inf until a request finishes)"""
+        with self._released:
+            return self._try_acquire(host)
+
+    def acquire(self, host: str):
+        """Wait until a request to host can start"""
+        with self._released:
+            while True:
+                wait = self._try_acquire(host)
+                if not wait:
+                    return
+                self._released.wait(None if wait == math.inf else wait)
+
+    async def acquire_async(self, host: str):
+        import asyncio
+        while True:
+            wait = self.try_acquire(host)
+            if not wait:
+                return
+            await asyncio.sleep(self.poll_seconds if wait == math.inf else wait)
+
+    def release(self, host: str, latency: float, status: Optional[int] = None,
+                retry_after: Optional[str] = None, error: bool = False):
+        """Finish a request to host that took latency seconds, with the response status or an error"""
+        with self._released:
+            state = self._host(host)
+            now = self.clock()
+            state.in_flight -= 1
+
+            throttled = status in THROTTLE_STATUS
+            error = error or (status is not None and status >= 500 and not throttled)
+            state.latency = latency if state.latency is None else (1 - self.smoothing) * state.latency + self.smoothing * latency
+            state.min_latency = latency if state.min_latency is None else min(state.min_latency, latency)
+            state.error_rate = (1 - self.smoothing) * state.error_rate + self.smoothing * error
+            state.errors += error
+            if throttled:
+                state.throttled += 1
+                delay = parse_retry_after(retry_after) if retry_after is not None else self.throttle_backoff
+                state.blocked_until = max(state.blocked_until, now + delay)
+
+            slow = (self.latency_factor is not None and state.latency > self.latency_factor * state.min_latency)
+            if throttled or slow or state.error_rate > self.max_error_rate:
+                # Requests in flight when we cut back see the same congestion; only cut once per round trip
+                if now - state.last_decrease >= state.latency:
+                    state.limit = max(self.min_concurrency, state.limit * self.decrease)
+                    state.last_decrease = now
+                    state.decreases += 1
+                    logging.debug('Reducing concurrency for %s to %d', host, state.limit)
+            elif not error and state.limit < self.max_concurrency:
+                state.limit = min(self.max_concurrency, state.limit + self.increase / int(state.limit))
+                state.increases += 1
+            self._released.notify_all()
+
+    def metrics(self) -> dict[str, dict[str, float]]:
+        with self._released:
+            now = self.clock()
+            return {host: dict(concurrency=int(state.limit), in_flight=state.in_flight, rate=state.rate,
+                               requests=state.requests, throttled=state.throttled, errors=state.errors,
+                               error_rate=state.error_rate, latency=state.latency, min_latency=state.min_latency,
+                               increases=state.increases, decreases=state.decreases,
+                               blocked_for=max(0., state.blocked_until - now))
+                    for host, state in self._hosts.items()}
+
+
+_default_controller = None
+
+def default_controller() -> AdaptiveController:
+    global _default_controller
+    if _default_controller is None:
+        _default_controller = AdaptiveController()
+    return _default_controller
+
+# Internal Cell
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def _adaptive_adapter_class():
+    from requests.adapters import HTTPAdapter
+
+    class AdaptiveAdapter(HTTPAdapter):
+        """HTTPAdapter that starts requests when controller allows, and retries throttled requests when it's ready"""
+        def __init__(self, controller: AdaptiveController, throttle_retries: int = 5, **kwargs):
+            self.controller = controller
+            self.throttle_retries = throttle_retries
+            super().__init__(**kwargs)
+
+        def send(self, request, **kwargs):
+            host = urlsplit(request.url).netloc
+            for attempt in range(self.throttle_retries + 1):
+                self.controller.acquire(host)
+                start = time.monotonic()
+                try:
+                    response = super().send(request, **kwargs)
+                except Exception:
+                    self.controller.release(host, time.monotonic() - start, error=True)
+                    raise
+                self.controller.release(host, time.monotonic() - start, status=response.status_code,
+                                        retry_after=response.headers.get('Retry-After'))
+                if response.status_code not in THROTTLE_STATUS or attempt == self.throttle_retries:
+                    return response
+                response.close()
+
+    AdaptiveAdapter.__qualname__ = 'AdaptiveAdapter'
+    return AdaptiveAdapter
+
+def __getattr__(name):
+    # AdaptiveAdapter subclasses requests' HTTPAdapter, so it's made when first used.
+    # It's left out of __all__ so `from webrefine.util import *` doesn't import requests.
+    if name == 'AdaptiveAdapter':
+        return _adaptive_adapter_class()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+# Cell
+import json
+from pathlib import Path
+from typing import Any, Union
+
+_missing = object()
+
+class TTLCache:
+    """JSON values that expire ttl seconds after they're set, in a SQLite database at path shared between processes"""
+    def __init__(self, path: Union[str, Path], ttl: float, clock: Callable[[], float] = time.time, timeout: float = 10.):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.clock = clock
+        self.timeout = timeout
+        # SQLite connections can only be used in the thread that made them
+        self._local = threading.local()
+
+    def _conn(self):
+        import sqlite3
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[tuple]:
+        import sqlite3
+        try:
+            return self._conn().execute(sql, params).fetchall()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f'Not using cache {self.path}: {e}')
+            return []
+
+    def get(self, key: str, default: Any = None) -> Any:
+        rows = self._execute('SELECT value FROM cache WHERE key = ? AND expires > ?', (key, self.clock()))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set(self, key: str, value: Any):
+        now = self.clock()
+        self._execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value), now + self.ttl))
+        self._execute('DELETE FROM cache WHERE expires <= ?', (now,))
+
+    def cached(self, key: str, func: Callable[[], Any]) -> Any:
+        """The value of key, calling func to set it if it's missing or expired"""
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        self._execute('DELETE FROM cache')
\ No newline at end of file